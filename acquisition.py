@@ -0,0 +1,122 @@
+import math
+from collections import namedtuple
+
+# One decimated bucket, t is the start of the bucket in ns, count = 0 means no raw samples landed in it
+Bucket = namedtuple("Bucket", ["t", "v_mean", "v_min", "v_max", "a_mean", "a_min", "a_max", "count"])
+
+
+class Decimator:
+    # Aggregates raw samples (or smaller buckets) into fixed time buckets with min / max / mean / count
+    def __init__(self, period: float):
+        self.period_ns = int(period * 1e9)
+        self.start_ns = None
+        self.last: Bucket = None
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self.v_sum = 0.0
+        self.a_sum = 0.0
+        self.v_min = math.inf
+        self.v_max = -math.inf
+        self.a_min = math.inf
+        self.a_max = -math.inf
+
+    def _close(self) -> Bucket:
+        if self.count:
+            bucket = Bucket(self.start_ns, self.v_sum / self.count, self.v_min, self.v_max,
+                            self.a_sum / self.count, self.a_min, self.a_max, self.count)
+        elif self.last is not None:
+            # Nothing was measured in this bucket, repeat the last values so there is still one bucket per period
+            bucket = self.last._replace(t=self.start_ns, count=0)
+        else:
+            bucket = Bucket(self.start_ns, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0)
+        self.last = bucket
+        self.start_ns += self.period_ns
+        self._reset()
+        return bucket
+
+    def _accumulate(self, t: int, v_sum: float, v_min: float, v_max: float, a_sum: float, a_min: float, a_max: float, count: int) -> [Bucket]:
+        if self.start_ns is None:
+            self.start_ns = t
+        closed = []
+        while t >= self.start_ns + self.period_ns:
+            closed.append(self._close())
+        if count:
+            self.count += count
+            self.v_sum += v_sum
+            self.a_sum += a_sum
+            self.v_min = min(self.v_min, v_min)
+            self.v_max = max(self.v_max, v_max)
+            self.a_min = min(self.a_min, a_min)
+            self.a_max = max(self.a_max, a_max)
+        return closed
+
+    def add(self, t: int, v: float, a: float) -> [Bucket]:
+        # Returns the buckets this sample closed, usually none
+        return self._accumulate(t, v, v, v, a, a, a, 1)
+
+    def add_bucket(self, b: Bucket) -> [Bucket]:
+        return self._accumulate(b.t, b.v_mean * b.count, b.v_min, b.v_max, b.a_mean * b.count, b.a_min, b.a_max, b.count)
+
+
+class Sampler:
+    # The raw sampling loop, reads the sensor on a fixed schedule and hands every closed 100ms and 1s bucket to the callbacks.
+    # load and connected are what the caller stamps on the stored buckets
+    def __init__(self, bucket_period: float = 0.1, max_lag_samples: int = 10):
+        self.bucket_period = bucket_period  # Seconds per stored sample
+        self.raw_period: float = 0.002  # Seconds between two raw reads
+        self.max_lag_samples = max_lag_samples  # How far behind the scheduler may fall before it skips slots
+        self.reader = None
+        self.load: float = 0
+        self.connected: bool = False
+        self.voltage: float = 0.0  # Last raw sample
+        self.current: float = 0.0
+        self.achieved_rate: float = 0.0  # Measured raw samples per second
+        self.overruns: int = 0  # Samples that started after their deadline
+        self.dropped_samples: int = 0  # Sample slots skipped after falling too far behind
+        self.is_running: bool = False
+
+    def set_adc_mode(self, mode: str, raw_period: float):
+        self.reader.set_mode(mode)
+        self.raw_period = raw_period
+
+    def run(self, clock, on_bucket, on_second):
+        # Blocks until stop(), on_bucket(bucket) / on_second(bucket) run in this thread
+        self.is_running = True
+        fast = Decimator(self.bucket_period)
+        slow = Decimator(1)
+        next_deadline = clock.now_ns()
+        rate_start = next_deadline
+        rate_samples = 0
+        while self.is_running:
+            self.voltage, self.current = self.reader.read()
+            t = self.reader.last_timestamp
+            for bucket in fast.add(t, self.voltage, self.current):
+                on_bucket(bucket)
+                for second in slow.add_bucket(bucket):
+                    on_second(second)
+
+            # Achieved raw rate, recalculated about once a second
+            rate_samples += 1
+            if t - rate_start >= 1_000_000_000:
+                self.achieved_rate = rate_samples * 1e9 / (t - rate_start)
+                rate_start = t
+                rate_samples = 0
+
+            # Next deadline is counted from the last deadline, not from now, so the time spent reading doesn't add up
+            period_ns = int(self.raw_period * 1e9)
+            next_deadline += period_ns
+            now = clock.now_ns()
+            if now > next_deadline:
+                self.overruns += 1
+                behind = (now - next_deadline) // period_ns
+                if behind > self.max_lag_samples:
+                    # Too far behind to catch up, skip the missed slots and start again from now
+                    self.dropped_samples += behind
+                    next_deadline += behind * period_ns
+            else:
+                clock.sleep((next_deadline - now) / 1e9)
+
+    def stop(self):
+        self.is_running = False
@@ -0,0 +1,75 @@
+import json
+from collections import namedtuple
+
+# One unit to test, serial may be None for units that are only counted
+BatchUnit = namedtuple("BatchUnit", ["adapter", "serial"])
+# Outcome of a tested unit, times in clock ns
+UnitResult = namedtuple("UnitResult", ["unit", "passed", "start", "end"])
+
+
+class BatchQueue:
+    # Units of a production batch tested one after another, the tester starts the next one as soon as a new unit gets plugged in.
+    # Keeps the outcomes and the timing for the throughput metrics
+    def __init__(self, units: [BatchUnit], profile: str = None, name: str = "", settle: float = 1.0):
+        self.name = name
+        self.units = list(units)
+        self.profile = profile  # Overrides the adapters' profiles for the whole batch
+        self.settle = settle  # Seconds between plugging a unit in and starting its test, so the first samples aren't the plug-in
+        self.position = 0  # Index of the next unit to test
+        self.results: [UnitResult] = []
+        self.needs_removal = False  # The last tested unit is still plugged in, the next one only starts after it was unplugged
+        self.current_start = None  # Clock ns the unit under test started
+
+    @property
+    def current(self) -> BatchUnit:
+        return self.units[self.position] if self.position < len(self.units) else None
+
+    @property
+    def done(self) -> bool:
+        return self.position >= len(self.units)
+
+    def unit_started(self, t: int):
+        self.current_start = t
+        self.needs_removal = True
+
+    def unit_finished(self, passed: bool, t: int):
+        self.results.append(UnitResult(self.current, passed, self.current_start, t))
+        self.position += 1
+        self.current_start = None
+
+    def unit_aborted(self):
+        # Unplugged or stopped during the test, it stays next in the queue
+        self.current_start = None
+
+    def idle_times(self) -> [float]:
+        # Seconds between the end of one unit and the start of the next
+        return [(b.start - a.end) / 1e9 for a, b in zip(self.results, self.results[1:])]
+
+    def units_per_hour(self) -> float:
+        if not self.results:
+            return 0.0
+        elapsed = (self.results[-1].end - self.results[0].start) / 1e9
+        return len(self.results) / elapsed * 3600 if elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        passed = sum(r.passed for r in self.results)
+        idle = self.idle_times()
+        mean_idle = f"{sum(idle) / len(idle):.1f}s" if idle else "-"
+        return f"{len(self.results)}/{len(self.units)} units tested, {passed} passed, {self.units_per_hour():.1f} units/hour, mean idle time {mean_idle}"
+
+
+def load_batch(path: str) -> BatchQueue:
+    # {"profile": optional profile name, "settle": optional seconds, "units": [{"adapter": name, "serial": "..."} or {"adapter": name, "count": n}]}
+    with open(path, "r") as f:
+        data = json.load(f)
+    units = []
+    for entry in data.get("units", []):
+        if "adapter" not in entry:
+            raise ValueError(f"Batch {path}: every unit needs an 'adapter'")
+        if "count" in entry:
+            units += [BatchUnit(entry["adapter"], None)] * int(entry["count"])
+        else:
+            units.append(BatchUnit(entry["adapter"], entry.get("serial")))
+    if not units:
+        raise ValueError(f"Batch {path} has no units")
+    return BatchQueue(units, data.get("profile"), path, float(data.get("settle", 1.0)))
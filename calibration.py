@@ -0,0 +1,66 @@
+import bisect
+import numpy as np
+from sample_ring import MAX_LOAD
+
+CALIBRATION_FILE = "pwm_mapping_data.csv"
+
+# Load setpoint of the short circuit test, stored as is in the load column where it marks the short circuit samples
+SHORT_CIRCUIT_LOAD = MAX_LOAD
+
+# What a setpoint converts to
+NORMAL = 0  # Interpolated inside the calibration
+SHORTED = 1  # Load fully on
+OVERCURRENT = 2  # More current than the calibration reaches, held at its highest point
+
+
+class CalibrationTable:
+    # Inverse of the load calibration, amps -> PWM duty. The (pwm, current) points are compiled once into sorted arrays with a
+    # monotone current axis, a whole set of setpoints converts in one np.interp call and a single one is a bisect
+    def __init__(self, mappings: [(float, float)]):
+        points = np.array(sorted(mappings), dtype=np.float64).reshape(-1, 2)
+        pwm, current = points[:, 0], points[:, 1]
+        # A reading that dipped below the one before doesn't make the load pull less with more duty
+        current = np.maximum.accumulate(current) if len(current) else current
+        # The lowest duty of equal currents, like the linear search found first
+        current, first = np.unique(current, return_index=True)
+        self.current = current
+        self.pwm = pwm[first]
+        # Lists for the single lookups, numpy's per call overhead is larger than the search on a table this size
+        self._current, self._pwm = self.current.tolist(), self.pwm.tolist()
+
+    def __len__(self) -> int:
+        return len(self.current)
+
+    @property
+    def max_current(self) -> float:
+        return float(self.current[-1]) if len(self.current) else 0.0
+
+    def duties(self, loads, max_current: float) -> (np.ndarray, np.ndarray):
+        # (duty, mode) for every load in % of the adapter's max_current, SHORT_CIRCUIT_LOAD for the short circuit test
+        if not len(self.current):
+            raise ValueError(f"No load calibration, {CALIBRATION_FILE} is empty")
+        loads = np.asarray(loads, dtype=np.float64)
+        amps = loads / 100 * max_current
+        duty = np.interp(amps, self.current, self.pwm)
+        mode = np.full(loads.shape, NORMAL, dtype=np.int8)
+        mode[amps > self.current[-1]] = OVERCURRENT
+        short = loads == SHORT_CIRCUIT_LOAD
+        mode[short] = SHORTED
+        duty[short] = 100
+        return np.minimum(duty, 100), mode
+
+    def duty(self, load: float, max_current: float) -> (float, int):
+        # Same as duties() for one load
+        if load == SHORT_CIRCUIT_LOAD:
+            return 100.0, SHORTED
+        current, pwm = self._current, self._pwm
+        if not current:
+            raise ValueError(f"No load calibration, {CALIBRATION_FILE} is empty")
+        amps = load / 100 * max_current
+        if amps > current[-1]:
+            return min(pwm[-1], 100.0), OVERCURRENT
+        i = bisect.bisect_left(current, amps)
+        if i == 0 or current[i] == amps:
+            return min(pwm[i], 100.0), NORMAL
+        ratio = (amps - current[i - 1]) / (current[i] - current[i - 1])
+        return min(pwm[i - 1] + ratio * (pwm[i] - pwm[i - 1]), 100.0), NORMAL
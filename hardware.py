@@ -0,0 +1,286 @@
+import math
+import random
+import threading
+from multiprocessing import RawValue
+from time import sleep, perf_counter_ns
+from ina219_reader import FastINA219Reader, FakeI2C
+
+
+class RealClock:
+    def now_ns(self) -> int:
+        return perf_counter_ns()
+
+    def sleep(self, seconds: float):
+        sleep(max(0.0, seconds))
+
+    def wait(self, event: threading.Event, seconds: float) -> bool:
+        # Sleep that ends early once the event is set, True if it was
+        return event.wait(max(0.0, seconds))
+
+
+class VirtualClock:
+    # Runs speed times faster than real time, shared by every thread so their timing stays consistent
+    def __init__(self, speed: float = 100.0):
+        self.speed = speed
+        self._real_start = perf_counter_ns()
+
+    def now_ns(self) -> int:
+        return int((perf_counter_ns() - self._real_start) * self.speed)
+
+    def sleep(self, seconds: float):
+        sleep(max(0.0, seconds) / self.speed)
+
+    def wait(self, event: threading.Event, seconds: float) -> bool:
+        return event.wait(max(0.0, seconds) / self.speed)
+
+
+class PiBackend:
+    # Real hardware, the Pi only libraries are imported here so the rest of the app runs anywhere
+    def __init__(self, settings):
+        import RPi.GPIO as GPIO
+        self.settings = settings
+        self.clock = RealClock()
+        self.GPIO = GPIO
+
+    def setup_gpio(self, inputs: [int], outputs: [int]):
+        self.GPIO.setmode(self.GPIO.BCM)
+        for pin in inputs:
+            self.GPIO.setup(pin, self.GPIO.IN, pull_up_down=self.GPIO.PUD_UP)
+        for pin in outputs:
+            self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def output(self, pin: int, high: bool):
+        self.GPIO.output(pin, self.GPIO.HIGH if high else self.GPIO.LOW)
+
+    def input(self, pin: int) -> bool:
+        return self.GPIO.input(pin) == self.GPIO.HIGH
+
+    def add_edge_callback(self, pin: int, callback, bouncetime: int):
+        # callback(pin) runs in the RPi.GPIO event thread on every debounced edge
+        self.GPIO.add_event_detect(pin, self.GPIO.BOTH, callback=callback, bouncetime=bouncetime)
+
+    def create_sensor(self) -> FastINA219Reader:
+        import board
+        import busio
+        return FastINA219Reader(busio.I2C(board.SCL, board.SDA, frequency=self.settings.i2c_frequency))
+
+    def create_pwm(self):
+        from rpi_hardware_pwm import HardwarePWM
+        pwm = HardwarePWM(pwm_channel=0, hz=60, chip=0)
+        pwm.change_frequency(10000)
+        return pwm
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class SimulatedPWM:
+    # Duty and state live in shared memory, so a forked sampler process sees the load the main process sets
+    def __init__(self):
+        self._duty = RawValue("d", 0.0)
+        self._running = RawValue("b", False)
+        self.frequency: float = 0.0
+
+    @property
+    def duty(self) -> float:
+        return self._duty.value
+
+    @duty.setter
+    def duty(self, value: float):
+        self._duty.value = value
+
+    @property
+    def running(self) -> bool:
+        return bool(self._running.value)
+
+    @running.setter
+    def running(self, value: bool):
+        self._running.value = value
+
+    def start(self, duty: float):
+        self.duty = duty
+        self.running = True
+
+    def stop(self):
+        self.duty = 0.0
+        self.running = False
+
+    def change_duty_cycle(self, duty: float):
+        if not 0 <= duty <= 100:
+            raise ValueError("Duty cycle must be between 0 and 100")
+        self.duty = duty
+
+    def change_frequency(self, hz: float):
+        self.frequency = hz
+
+
+class SimulatedAdapter:
+    # Adapter + load model driven by the PWM duty, the duty -> current relation comes from the calibration (pwm_mappings)
+    def __init__(self, pwm: SimulatedPWM, pwm_mappings: [(float, float)], clock, nominal_voltage: float = 5.0,
+                 max_current: float = 2.0, output_resistance: float = 0.08, droop_knee: float = 0.9,
+                 ripple: float = 0.02, noise: float = 0.005, opp_load: float = 130, recovery_time: float = 1.0,
+                 short_circuit_protection: bool = True):
+        self.pwm = pwm
+        self.mappings = sorted(pwm_mappings)
+        self.clock = clock
+        self.nominal_voltage = nominal_voltage
+        self.max_current = max_current
+        self.output_resistance = output_resistance  # Linear droop in ohms
+        self.droop_knee = droop_knee  # Fraction of the OPP point after which the voltage falls faster
+        self.ripple = ripple  # Ripple amplitude in V
+        self.noise = noise  # Gaussian noise sigma in V
+        self.opp_load = opp_load  # Load in % of max_current where the adapter trips
+        self.recovery_time = recovery_time  # Seconds the output stays off after a trip
+        self.short_circuit_protection = short_circuit_protection
+        self._connected = RawValue("b", True)  # Shared for the same reason as the PWM state
+        self.listeners = []  # Called with no args when the adapter is plugged in or out, like a GPIO edge
+        self.trips: int = 0
+        self._off_until_ns: int = 0
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return bool(self._connected.value)
+
+    @connected.setter
+    def connected(self, value: bool):
+        self._connected.value = value
+
+    def load_current(self) -> float:
+        # Current the load would pull at the nominal voltage, interpolated from the calibration
+        duty = self.pwm.duty if self.pwm.running else 0.0
+        if not self.mappings or duty <= self.mappings[0][0]:
+            return 0.0
+        for (pwm1, current1), (pwm2, current2) in zip(self.mappings, self.mappings[1:]):
+            if pwm1 <= duty <= pwm2:
+                return current1 + (duty - pwm1) / (pwm2 - pwm1) * (current2 - current1)
+        return self.mappings[-1][1]
+
+    def measure(self) -> (float, float):
+        if not self.connected:
+            return 0.0, 0.0
+        now = self.clock.now_ns()
+        with self._lock:
+            if now < self._off_until_ns:
+                # Output is off after OPP or short circuit protection kicked in
+                return 0.0, 0.0
+
+            if self.pwm.running and self.pwm.duty >= 100:
+                # Load MOSFET fully on = short circuit
+                if self.short_circuit_protection:
+                    self._off_until_ns = now + int(self.recovery_time * 1e9)
+                    self.trips += 1
+                    return 0.0, 0.0
+                return 0.4, self.max_current * self.opp_load / 100
+
+            target = self.load_current()
+            trip_current = self.max_current * self.opp_load / 100
+            if target > trip_current:
+                self._off_until_ns = now + int(self.recovery_time * 1e9)
+                self.trips += 1
+                return 0.0, 0.0
+
+        v = self.nominal_voltage - self.output_resistance * target
+        knee = trip_current * self.droop_knee
+        if target > knee:
+            # Output starts to fold back close to the trip point
+            v -= self.nominal_voltage * 0.1 * ((target - knee) / (trip_current - knee)) ** 2
+        t = now / 1e9
+        v += self.ripple * math.sin(2 * math.pi * 100 * t) + random.gauss(0, self.noise)
+        a = target * v / self.nominal_voltage + random.gauss(0, self.noise / 10)
+        return max(v, 0.0), max(a, 0.0)
+
+    def plug(self):
+        self.connected = True
+        for listener in self.listeners:
+            listener()
+
+    def unplug(self):
+        self.connected = False
+        for listener in self.listeners:
+            listener()
+
+
+class SimulatedBackend:
+    # Runs the whole tester without the Pi, speed > 1 makes every sleep and timestamp faster than real time
+    def __init__(self, settings, speed: float = 1.0, **adapter):
+        self.settings = settings
+        self.clock = VirtualClock(speed) if speed != 1 else RealClock()
+        self.pwm = SimulatedPWM()
+        self.adapter = SimulatedAdapter(self.pwm, settings.pwm_mappings, self.clock, **adapter)
+        self.connection_pin = None
+        self.pins = {}
+
+    def setup_gpio(self, inputs: [int], outputs: [int]):
+        # Only input is the connection pin
+        self.connection_pin = inputs[0] if inputs else None
+        for pin in outputs:
+            self.pins[pin] = False
+
+    def output(self, pin: int, high: bool):
+        self.pins[pin] = high
+
+    def input(self, pin: int) -> bool:
+        if pin == self.connection_pin:
+            return self.adapter.connected
+        return self.pins.get(pin, False)
+
+    def add_edge_callback(self, pin: int, callback, bouncetime: int):
+        if pin == self.connection_pin:
+            self.adapter.listeners.append(lambda: callback(pin))
+
+    def create_sensor(self) -> FastINA219Reader:
+        i2c = FakeI2C(source=self.adapter.measure, frequency=0, now_ns=self.clock.now_ns)
+        return FastINA219Reader(i2c, now_ns=self.clock.now_ns)
+
+    def create_pwm(self) -> SimulatedPWM:
+        return self.pwm
+
+    def cleanup(self):
+        self.pins.clear()
+
+
+class ConnectionMonitor:
+    # Tracks the connection pin with edge interrupts, subscribers get called with the new state on every change
+    def __init__(self, backend, pin: int, bouncetime: int = 50):
+        self.backend = backend
+        self.pin = pin
+        self.bouncetime = bouncetime  # ms
+        self.connected: bool = False
+        self.changed_at: int = 0  # Clock ns of the last change
+        self.changes: int = 0
+        self.subscribers = []
+        self._condition = threading.Condition()
+
+    def start(self):
+        self.connected = self.backend.input(self.pin)
+        self.changed_at = self.backend.clock.now_ns()
+        self.backend.add_edge_callback(self.pin, self._on_edge, self.bouncetime)
+        return self.connected
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def _on_edge(self, pin):
+        # The level is read again, bounces that end on the same level as before are ignored
+        connected = self.backend.input(self.pin)
+        with self._condition:
+            if connected == self.connected:
+                return
+            self.connected = connected
+            self.changed_at = self.backend.clock.now_ns()
+            self.changes += 1
+            self._condition.notify_all()
+        for callback in self.subscribers:
+            callback(connected)
+
+    def wait_for(self, connected: bool, timeout: float = None) -> bool:
+        # Blocks until the state matches, returns False on timeout
+        with self._condition:
+            return self._condition.wait_for(lambda: self.connected == connected, timeout)
+
+
+def create_backend(settings):
+    if settings.hardware_backend == "sim":
+        return SimulatedBackend(settings, **settings.simulation)
+    return PiBackend(settings)
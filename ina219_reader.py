@@ -0,0 +1,299 @@
+import math
+import random
+import sys
+import threading
+from time import perf_counter_ns
+import numpy as np
+
+# INA219 registers
+REG_CONFIG = 0x00
+REG_SHUNT_VOLTAGE = 0x01
+REG_BUS_VOLTAGE = 0x02
+REG_POWER = 0x03
+REG_CURRENT = 0x04
+REG_CALIBRATION = 0x05
+
+# Bus voltage register flags
+CNVR = 0x02  # Conversion ready, cleared by reading the power register
+OVF = 0x01  # Math overflow
+
+BUS_VOLTAGE_LSB = 0.004  # V
+SHUNT_VOLTAGE_LSB = 0.00001  # V
+
+# Config register fields
+CONFIG_BUS_RANGE_32V = 0x2000
+CONFIG_GAIN_8_320MV = 0x1800
+CONFIG_MODE_SHUNT_BUS_CONTINUOUS = 0x0007
+
+# ADC settings the chip supports, name: (register value, conversion time in s, averaged samples)
+ADC_MODES = {
+    "9BIT_1S": (0x0, 0.000084, 1),
+    "10BIT_1S": (0x1, 0.000148, 1),
+    "11BIT_1S": (0x2, 0.000276, 1),
+    "12BIT_1S": (0x3, 0.000532, 1),
+    "12BIT_2S": (0x9, 0.00106, 2),
+    "12BIT_4S": (0xA, 0.00213, 4),
+    "12BIT_8S": (0xB, 0.00426, 8),
+    "12BIT_16S": (0xC, 0.00851, 16),
+    "12BIT_32S": (0xD, 0.01702, 32),
+    "12BIT_64S": (0xE, 0.03405, 64),
+    "12BIT_128S": (0xF, 0.06810, 128),
+}
+ADC_CODES = {code: name for name, (code, _, _) in ADC_MODES.items()}
+
+
+def conversion_time(mode: str) -> float:
+    # Shunt and bus are converted one after the other, so one sample takes both
+    return 2 * ADC_MODES[mode][1]
+
+
+class FastINA219Reader:
+    # Reads the bus and shunt registers directly instead of going through the adafruit properties
+    def __init__(self, i2c, address: int = 0x40, shunt_ohms: float = 0.1, capacity: int = 4096, timeout: float = 0.1, now_ns=perf_counter_ns):
+        self.i2c = i2c
+        self.now_ns = now_ns  # Timestamps for the ring, can be a virtual clock
+        self.address = address
+        self.shunt_ohms = shunt_ohms
+        self.base_timeout_ns = int(timeout * 1e9)
+        self.timeout_ns = self.base_timeout_ns
+        # Preallocated ring of raw samples, index counts every sample ever written
+        self.capacity = capacity
+        self.voltage = np.zeros(capacity, dtype=np.float32)
+        self.current = np.zeros(capacity, dtype=np.float32)
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.index: int = 0
+        self.last_voltage: float = 0.0
+        self.last_current: float = 0.0
+        self.last_timestamp: int = 0
+        self.shunt_voltage: float = 0.0
+        self.stale_polls: int = 0  # Bus register reads without a new conversion
+        self.timeouts: int = 0
+        self.overflows: int = 0
+        self.mode: str = None
+        self._reg = bytearray(1)
+        self._buf = bytearray(2)
+        self._lock = threading.Lock()
+
+    def _lock_bus(self):
+        while not self.i2c.try_lock():
+            pass
+
+    def set_mode(self, mode: str):
+        self.configure(ADC_MODES[mode][0], ADC_MODES[mode][0])
+        self.mode = mode
+        # Slow averaging modes take longer than the default timeout
+        self.timeout_ns = max(self.base_timeout_ns, int(3 * conversion_time(mode) * 1e9))
+
+    def configure(self, bus_adc: int, shunt_adc: int):
+        # 32V range, 320mV shunt range, continuous shunt and bus conversions
+        config = CONFIG_BUS_RANGE_32V | CONFIG_GAIN_8_320MV | (bus_adc << 7) | (shunt_adc << 3) | CONFIG_MODE_SHUNT_BUS_CONTINUOUS
+        with self._lock:
+            self._lock_bus()
+            try:
+                self.i2c.writeto(self.address, bytes([REG_CONFIG, config >> 8, config & 0xFF]))
+            finally:
+                self.i2c.unlock()
+
+    def _read_register(self, reg: int) -> int:
+        self._reg[0] = reg
+        self.i2c.writeto_then_readfrom(self.address, self._reg, self._buf)
+        return (self._buf[0] << 8) | self._buf[1]
+
+    def _read_locked(self):
+        deadline = perf_counter_ns() + self.timeout_ns
+        raw_bus = self._read_register(REG_BUS_VOLTAGE)
+        while not raw_bus & CNVR:
+            # Old conversion, wait for a new one so the same value isn't stored twice
+            self.stale_polls += 1
+            if perf_counter_ns() > deadline:
+                self.timeouts += 1
+                return self.last_voltage, self.last_current
+            raw_bus = self._read_register(REG_BUS_VOLTAGE)
+
+        raw_shunt = self._read_register(REG_SHUNT_VOLTAGE)
+        # Reading power clears CNVR for the next poll
+        self._read_register(REG_POWER)
+        if raw_bus & OVF:
+            self.overflows += 1
+        if raw_shunt & 0x8000:
+            raw_shunt -= 0x10000
+
+        self.shunt_voltage = raw_shunt * SHUNT_VOLTAGE_LSB
+        self.last_voltage = (raw_bus >> 3) * BUS_VOLTAGE_LSB
+        self.last_current = self.shunt_voltage / self.shunt_ohms
+        return self.last_voltage, self.last_current
+
+    def _store(self, t: int, v: float, a: float):
+        self.last_timestamp = t
+        i = self.index % self.capacity
+        self.timestamps[i] = t
+        self.voltage[i] = v
+        self.current[i] = a
+        self.index += 1
+
+    def read(self) -> (float, float):
+        # One fresh sample, (V, A)
+        with self._lock:
+            self._lock_bus()
+            try:
+                v, a = self._read_locked()
+            finally:
+                self.i2c.unlock()
+            self._store(self.now_ns(), v, a)
+        return v, a
+
+    def burst(self, n: int) -> int:
+        # Reads n samples back to back while holding the bus, returns the index of the first one
+        with self._lock:
+            first = self.index
+            self._lock_bus()
+            try:
+                for _ in range(n):
+                    v, a = self._read_locked()
+                    self._store(self.now_ns(), v, a)
+            finally:
+                self.i2c.unlock()
+        return first
+
+    def latest(self, n: int) -> (np.ndarray, np.ndarray, np.ndarray):
+        # Copies of the last n samples, oldest first
+        n = min(n, self.index, self.capacity)
+        idx = np.arange(self.index - n, self.index) % self.capacity
+        return self.timestamps[idx], self.voltage[idx], self.current[idx]
+
+
+class FakeI2C:
+    # Stand-in for busio.I2C that behaves like an INA219, for running and benchmarking off the Pi
+    def __init__(self, source=None, frequency: int = 400000, conversion_time: float = 0.000168, shunt_ohms: float = 0.1,
+                 now_ns=perf_counter_ns, noise: float = 0.0):
+        # source() -> (bus voltage V, current A)
+        # frequency = 0 skips the transfer time, now_ns can be a virtual clock so conversions follow it
+        # noise is the sigma of the voltage noise in one unaveraged conversion, the current noise is noise / 10
+        self.source = source if source is not None else (lambda: (5.0, 0.0))
+        self.noise = noise
+        self.averaged: int = 1
+        self.frequency = frequency
+        self.now_ns = now_ns
+        self.shunt_ohms = shunt_ohms
+        self.conversion_time_ns = int(conversion_time * 1e9)
+        self.registers = {REG_CONFIG: 0x399F, REG_CALIBRATION: 0, REG_POWER: 0, REG_CURRENT: 0}
+        self.transactions: int = 0
+        self._last_conversion = now_ns()
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def try_lock(self) -> bool:
+        return self._lock.acquire(blocking=False)
+
+    def unlock(self):
+        self._lock.release()
+
+    def _transfer(self, n_bytes: int):
+        # Start + address + data bytes + ack bits + stop, busy wait because sleep() is too coarse
+        self.transactions += 1
+        if not self.frequency:
+            return
+        bits = 2 + 9 * (1 + n_bytes)
+        end = perf_counter_ns() + int(bits * 1e9 / self.frequency)
+        while perf_counter_ns() < end:
+            pass
+
+    def _convert(self):
+        now = self.now_ns()
+        if now - self._last_conversion >= self.conversion_time_ns:
+            self._last_conversion = now
+            self._ready = True
+
+    def _noise(self, sigma: float) -> float:
+        # Averaging on the chip lowers the noise by sqrt(samples)
+        return random.gauss(0, sigma / math.sqrt(self.averaged)) if sigma else 0.0
+
+    def _register(self, reg: int) -> int:
+        self._convert()
+        if reg == REG_BUS_VOLTAGE:
+            v, _ = self.source()
+            v += self._noise(self.noise)
+            raw = (max(0, min(int(round(v / BUS_VOLTAGE_LSB)), 0x1FFF)) << 3) & 0xFFF8
+            return raw | (CNVR if self._ready else 0)
+        elif reg == REG_SHUNT_VOLTAGE:
+            _, a = self.source()
+            a += self._noise(self.noise / 10)
+            raw = int(round(a * self.shunt_ohms / SHUNT_VOLTAGE_LSB))
+            return max(-32000, min(raw, 32000)) & 0xFFFF
+        elif reg == REG_POWER:
+            self._ready = False
+        return self.registers.get(reg, 0)
+
+    def writeto(self, address: int, buffer, **kwargs):
+        self._transfer(len(buffer))
+        if len(buffer) == 3:
+            self.registers[buffer[0]] = (buffer[1] << 8) | buffer[2]
+            if buffer[0] == REG_CONFIG:
+                # Conversion time follows the ADC setting, like on the chip
+                mode = ADC_CODES.get((self.registers[REG_CONFIG] >> 3) & 0xF, "12BIT_1S")
+                self.conversion_time_ns = int(conversion_time(mode) * 1e9)
+                self.averaged = ADC_MODES[mode][2]
+                self._ready = False
+
+    def writeto_then_readfrom(self, address: int, buffer_out, buffer_in, **kwargs):
+        self._transfer(len(buffer_out) + len(buffer_in) + 1)
+        value = self._register(buffer_out[0])
+        buffer_in[0] = (value >> 8) & 0xFF
+        buffer_in[1] = value & 0xFF
+
+
+def benchmark(reader: FastINA219Reader, seconds: float = 2.0) -> dict:
+    start = perf_counter_ns()
+    first = reader.index
+    polls = reader.stale_polls
+    while perf_counter_ns() - start < seconds * 1e9:
+        reader.burst(50)
+    elapsed = (perf_counter_ns() - start) / 1e9
+    samples = reader.index - first
+    return {
+        "samples": samples,
+        "rate": samples / elapsed,
+        "stale_polls": reader.stale_polls - polls,
+        "timeouts": reader.timeouts,
+    }
+
+
+def benchmark_adc_modes(reader: FastINA219Reader, seconds: float = 1.0) -> [dict]:
+    # Noise floor and reachable sample rate of every ADC mode, run it with a steady load on the adapter
+    results = []
+    old_mode = reader.mode
+    for mode in ADC_MODES:
+        reader.set_mode(mode)
+        reader.read()  # First conversion after a config write is not valid yet
+        res = benchmark(reader, seconds)
+        n = min(res["samples"], reader.capacity)
+        _, v, a = reader.latest(n)
+        results.append({
+            "mode": mode,
+            "conversion_time": conversion_time(mode),
+            "expected_rate": 1 / conversion_time(mode),
+            "rate": res["rate"],
+            "v_noise": float(np.std(v)),
+            "a_noise": float(np.std(a)),
+        })
+    if old_mode is not None:
+        reader.set_mode(old_mode)
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "pi":
+        # Only while the main app isn't running, it would fight over the bus
+        import board
+        import busio
+        bench_reader = FastINA219Reader(busio.I2C(board.SCL, board.SDA, frequency=400000))
+    else:
+        for freq in (100000, 400000, 1000000):
+            res = benchmark(FastINA219Reader(FakeI2C(frequency=freq)))
+            print(f"{freq / 1000:.0f} kHz: {res['rate']:.0f} samples/s, {res['stale_polls']} stale polls, {res['timeouts']} timeouts")
+        bench_reader = FastINA219Reader(FakeI2C(frequency=400000, noise=0.02))
+
+    print(f"{'Mode':<12}{'Conv (ms)':>10}{'Max (Hz)':>10}{'Got (Hz)':>10}{'V noise (mV)':>14}{'A noise (mA)':>14}")
+    for row in benchmark_adc_modes(bench_reader, 0.5 if len(sys.argv) < 3 else float(sys.argv[2])):
+        print(f"{row['mode']:<12}{row['conversion_time'] * 1000:>10.3f}{row['expected_rate']:>10.0f}{row['rate']:>10.0f}"
+              f"{row['v_noise'] * 1000:>14.2f}{row['a_noise'] * 1000:>14.3f}")
@@ -0,0 +1,194 @@
+import json
+import os
+import sys
+import colorama
+import numpy as np
+from sample_ring import FIELDS
+from profiles import DWELL, SCHEDULE, phase_bounds
+
+MAGIC = b"PATJRNL1"
+HEADER_SIZE = 16384  # Magic, record count, capacity, metadata length, metadata JSON. The schedule and the records follow it
+RECORD = np.dtype(list(FIELDS))  # Packed, same columns as the sample ring
+JOURNAL_DIR = "journals"
+
+
+class SampleJournal:
+    # Test samples appended to a preallocated memory mapped file, so a test survives the process dying or the Pi browning out.
+    # Records are synced before the count that publishes them, a journal read after a crash only ever has whole records.
+    # The test's schedule has its own region, sized when the journal is created, so a long profile doesn't overflow the metadata
+    def __init__(self, path: str, capacity: int = 36000, meta: dict = None, create: bool = True, schedule: np.ndarray = None):
+        self.path = path
+        if create:
+            self.schedule_rows = 0 if schedule is None else len(schedule)
+            with open(path, "wb") as f:
+                f.truncate(self._records_offset() + capacity * RECORD.itemsize)
+            try:
+                self._map(capacity)
+                self.header[:8] = np.frombuffer(MAGIC, dtype=np.uint8)
+                self.count = 0
+                self.meta = {"schedule_rows": self.schedule_rows}
+                self.set_meta(meta or {})
+                if schedule is not None:
+                    self.set_schedule(schedule)
+                self.sync()
+            except (ValueError, OSError):
+                # A journal that was never complete would be left as an orphan recovery can't read
+                self.header = self.numbers = self.schedule = self.records = None
+                os.remove(path)
+                raise
+        else:
+            with open(path, "rb") as f:
+                head = f.read(HEADER_SIZE)
+            if head[:8] != MAGIC:
+                raise ValueError(f"{path} is not a sample journal")
+            count, capacity, meta_len = np.frombuffer(head, dtype=np.int64, count=3, offset=8)
+            self.meta = json.loads(head[32:32 + meta_len].decode()) if meta_len else {}
+            # Journals from before the schedule region have it in the metadata
+            self.schedule_rows = self.meta.get("schedule_rows", 0)
+            self._map(int(capacity))
+            self.count = int(count)
+
+    def _records_offset(self) -> int:
+        return HEADER_SIZE + self.schedule_rows * SCHEDULE.itemsize
+
+    def _map(self, capacity: int):
+        self.capacity = capacity
+        self.header = np.memmap(self.path, dtype=np.uint8, mode="r+", shape=(HEADER_SIZE,))
+        self.numbers = self.header[8:32].view(np.int64)  # count, capacity, metadata length
+        self.numbers[1] = capacity
+        self.schedule = np.memmap(self.path, dtype=SCHEDULE, mode="r+", offset=HEADER_SIZE, shape=(self.schedule_rows,)) if self.schedule_rows else None
+        self.records = np.memmap(self.path, dtype=RECORD, mode="r+", offset=self._records_offset(), shape=(capacity,))
+
+    def _grow(self, capacity: int):
+        self.sync()
+        with open(self.path, "r+b") as f:
+            f.truncate(self._records_offset() + capacity * RECORD.itemsize)
+        self._map(capacity)
+
+    def append(self, columns: [np.ndarray]):
+        # Columns in FIELDS order, as returned by SampleRing.read / a snapshot, visible to recovery after the next sync()
+        n = len(columns[0])
+        if self.count + n > self.capacity:
+            self._grow(max(self.capacity * 2, self.count + n))
+        chunk = self.records[self.count:self.count + n]
+        for (name, _), col in zip(FIELDS, columns):
+            chunk[name] = col
+        self.count += n
+
+    def set_meta(self, meta: dict):
+        self.meta.update(meta)
+        data = json.dumps(self.meta, default=lambda o: o.item()).encode()
+        if 32 + len(data) > HEADER_SIZE:
+            raise ValueError("Journal metadata too large")
+        self.header[32:32 + len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self.numbers[2] = len(data)
+
+    def set_schedule(self, schedule: np.ndarray):
+        # Same rows as the journal was created with, only their indices change while the test runs
+        self.schedule[:] = schedule
+
+    def sync(self):
+        # Records first, then the count that makes them valid (msync)
+        if self.schedule is not None:
+            self.schedule.flush()
+        self.records.flush()
+        self.numbers[0] = self.count
+        self.header.flush()
+
+    def columns(self) -> dict:
+        # Read-only field views of the synced records as plain arrays, nothing is copied
+        cols = {}
+        for name, _ in FIELDS:
+            col = np.asarray(self.records[name][:self.count])
+            col.flags.writeable = False
+            cols[name] = col
+        return cols
+
+    def close(self):
+        # The mappings close once the last view of them is gone
+        self.sync()
+        self.header = self.numbers = self.schedule = self.records = None
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+def orphaned_journals(directory: str = JOURNAL_DIR) -> [str]:
+    # Journals are deleted when a test ends, one that is still here belongs to a test the process never finished
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".journal"))
+
+
+def recovered_schedule(journal: SampleJournal) -> np.ndarray:
+    # The schedule with the sample indices every step ran between, None for journals from before it was journaled
+    if journal.schedule is not None:
+        return np.array(journal.schedule)
+    if journal.meta.get("schedule"):
+        # Journals from before the schedule region, and the used column, get it as -1
+        return np.array([tuple(row) + (-1,) * (len(SCHEDULE.names) - len(row)) for row in journal.meta["schedule"]], dtype=SCHEDULE)
+    return None
+
+
+def recovered_test_values(journal: SampleJournal, schedule: np.ndarray) -> list:
+    # Phase bounds as the test would have them had it been stopped at the last journaled sample. Phases 1 and 2 get the steps
+    # that ran from the schedule like run_steps, one that is excluded or never started stays at (0, 0). Phase 3 ends at the
+    # last sample, the test sets that even without phase 3
+    meta, n = journal.meta, journal.count
+    test_values = meta.get("test_values") or [{"start_index": 0, "stop_index": 0}, {"start_index": 0, "stop_index": 0},
+                                              {"start_index": 0, "stop_index": 0, "OPP_trip_index": [], "OPP_trip_load": [], "OPP_brackets": [], "short_circuit": False}]
+    load = journal.records["load"][:n]
+    for phase in (1, 2):
+        values = test_values[phase - 1]
+        if values["stop_index"] or not meta["phases"][phase - 1][0]:
+            continue
+        if schedule is None:
+            # No steps to go by, the phase that was running gets the rest of the samples
+            values["stop_index"] = n
+            break
+        start, stop = phase_bounds(schedule, phase)
+        dwells = schedule[(schedule["phase"] == phase) & (schedule["kind"] == DWELL)]
+        if stop and dwells["load"][0] > 0:
+            # Without the 0s before the first step, like the test
+            loaded = np.flatnonzero(load[start:stop] > 0)
+            start += int(loaded[0]) if len(loaded) else 0
+        values["start_index"], values["stop_index"] = start, stop
+    if not test_values[2]["stop_index"]:
+        test_values[2]["stop_index"] = n
+    return test_values
+
+
+def recover(path: str) -> str:
+    # Evaluates an orphaned journal like a finished test and writes it as a normal HDF5 test file, returns the file name
+    from subclasses import Adapter, AppSettings, DataStorage, EvaluateResults
+    journal = SampleJournal(path, create=False)
+    meta = journal.meta
+    cols = journal.columns()
+    schedule = recovered_schedule(journal)
+    test_values = recovered_test_values(journal, schedule)
+    settings = AppSettings()
+    settings.phase1, settings.phase2, settings.phase3 = meta["phases"]
+    adapter = Adapter(*meta["adapter"])
+    results = EvaluateResults(DataStorage())
+    results.recovered_from = os.path.basename(path)
+    results.profile = meta.get("profile")
+    results.serial = meta.get("serial")
+    if schedule is not None:
+        results.schedule = schedule
+    results.eval(cols["voltage"], cols["current"], cols["load"], cols["timestamps"], cols["v_min"], cols["v_max"], test_values, adapter)
+    fname = results.write_data_into_file(adapter, settings)
+    journal.delete()
+    return fname
+
+
+if __name__ == "__main__":
+    # python journal.py recover [journal files], all orphaned journals if none are given
+    if len(sys.argv) < 2 or sys.argv[1] != "recover":
+        print("Usage: python journal.py recover [journal ...]")
+        sys.exit(1)
+    for path in sys.argv[2:] or orphaned_journals():
+        try:
+            print(colorama.Fore.GREEN, f"Recovered {path} -> {recover(path)}", colorama.Fore.RESET)
+        except Exception as e:
+            print(colorama.Fore.RED, f"Couldn't recover {path}: {e}", colorama.Fore.RESET)
@@ -19,6 +19,8 @@ class Dashboard(Dash):
     def __init__(self):
         self.tester = Tester()
         self.tester.setup()
+        self.connection_version = 0  # Bumped on every plug / unplug, each browser tab keeps the last one it has shown
+        self.tester.connection.subscribe(self.on_connection_change)
         self.update_adapter_dropdowns = False
         self.disp_test = None
         self.adapter_to_delete = None
@@ -27,17 +29,33 @@ class Dashboard(Dash):
         self.layout = self.create_layout()
         self.register_callbacks()
 
-    def create_graph(self, voltages, currents, load):
+    def create_graph(self, voltages, currents, load, timestamps, v_min, v_max):
         if len(voltages) == 0:
             return empty_fig
         fig = go.Figure()
-        if self.tester.settings.high_res:
-            x_values = [i * .5 for i in range(len(voltages))]
-        elif self.tester.settings.per_sec:
-            x_values = [i for i in range(len(voltages))]
-        else:
-            x_values = [i * .1 for i in range(len(voltages))]
+        # Real sample times, so the axis stays correct even if the sampler was late
+        x_values = self.tester.data_storage.seconds(timestamps)
 
+        # Min / max of the raw samples in each bucket, shows glitches the means hide
+        fig.add_trace(go.Scatter(
+            x=x_values,
+            y=v_min,
+            mode="lines",
+            line=dict(color=YELLOW, width=0),
+            showlegend=False,
+            hoverinfo="skip",
+            yaxis="y1"
+        ))
+        fig.add_trace(go.Scatter(
+            x=x_values,
+            y=v_max,
+            mode="lines",
+            name="Voltage min/max",
+            fill="tonexty",
+            fillcolor="rgba(255,226,0,0.25)",
+            line=dict(color=YELLOW, width=0),
+            yaxis="y1"
+        ))
         fig.add_trace(go.Scatter(
             x=x_values,
             y=voltages,
@@ -66,7 +84,7 @@ class Dashboard(Dash):
             xaxis_title="Time (seconds)",
             yaxis=dict(
                 title="Voltage (V) / Current (A)",
-                range=[0, 6 if self.tester.data_storage.voltage[-1] <= 6 else 12.5]
+                range=[0, 6 if voltages[-1] <= 6 else 12.5]
             ),
             yaxis2=dict(
                 title="Load (%)",
@@ -84,6 +102,9 @@ class Dashboard(Dash):
 
         return fig
 
+    def on_connection_change(self, connected: bool):
+        self.connection_version += 1
+
     def return_dd_opt(self):
         return [{"label": html.Span(adt.name), "value": str(i)} for i, adt in enumerate(self.tester.testable_adapters.adapters)]
 
@@ -141,7 +162,7 @@ class Dashboard(Dash):
 
     def delete_and_recreate_ripple_tester(self):
         self.just_delete_ripple_tester()
-        self.ripple_tester = RippleTester()
+        self.ripple_tester = RippleTester(self.tester.clock)
 
     def just_delete_ripple_tester(self):
         del self.ripple_tester
@@ -203,10 +224,19 @@ class Dashboard(Dash):
             if is_paused:
                 return no_update
 
+            if self.tester.settings.per_sec:
+                # 1s buckets, load is the load at the end of each second
+                snap = self.tester.data_storage.seconds_snapshot()
+            else:
+                snap = self.tester.data_storage.snapshot()
+            # One snapshot, so every column has the same length
             return {
-                "voltages": self.tester.data_storage.voltage,
-                "currents": self.tester.data_storage.current,
-                "load": self.tester.data_storage.load,
+                "voltages": snap.voltage,
+                "currents": snap.current,
+                "load": snap.load,
+                "timestamps": snap.timestamps,
+                "v_min": snap.v_min,
+                "v_max": snap.v_max,
                 "connected": self.tester.is_connected
             }
 
@@ -217,22 +247,34 @@ class Dashboard(Dash):
             Output("voltage", "children"),
             Output("current", "children"),
             Output("load", "children"),
-            Output("Adapter-connection-status", "className")
             ],
             Input("data-store", "data")
         )
         def update_graph(data):
-            g = self.create_graph(data["voltages"], data["currents"], data["load"])
+            g = self.create_graph(data["voltages"], data["currents"], data["load"], data["timestamps"], data["v_min"], data["v_max"])
             try:
                 res = (g,
                        f"{round(data['voltages'][-1], 2)}V",
                        f"{round(data['currents'][-1], 2)}A",
-                       f"{round(data['load'][-1])}%",
-                       "Adapter-connection-status connected" if data["connected"] else "Adapter-connection-status disconnected")
+                       f"{round(data['load'][-1])}%")
             except IndexError:
-                res = (g, "Voltage", "Current", "Load", "Adapter-connection-status disconnected")
+                res = (g, "Voltage", "Current", "Load")
             return res
 
+        # Connection indicator, polled often but only sends an update after a connection change
+        @self.callback(
+            Output("Adapter-connection-status", "className"),
+            Output("connection-version", "data"),
+            Input("connection-interval", "n_intervals"),
+            State("connection-version", "data")
+        )
+        def update_connection_status(n_intervals, seen_version):
+            if seen_version == self.connection_version:
+                return no_update, no_update
+            if self.tester.is_connected:
+                return "Adapter-connection-status connected", self.connection_version
+            return "Adapter-connection-status disconnected", self.connection_version
+
         # Get value from adapter-dropdown on change
         @self.callback(
             Input("adapter-type-dropdown", "value")
@@ -657,12 +699,14 @@ class Dashboard(Dash):
             Output("adapter-type-dropdown", "options"),
             Output("adapter-to-delete", "options"),
             Output("past-tests-dropdown", "options"),
+            Output("cmd-seq", "data"),
             Input("cmd-interval", "n_intervals"),
             State("cmd", "children"),
             State("stop-btn", "className"),
+            State("cmd-seq", "data"),
             prevent_initial_call=True
         )
-        def update_cmd(n_intervals, current_children, bc):
+        def update_cmd(n_intervals, current_children, bc, seen_seq):
             # Some other things that update with this interval
             dd1 = no_update
             dd2 = no_update
@@ -680,14 +724,17 @@ class Dashboard(Dash):
                 # If test is not running disable button
                 btnclass = "stop-btn-off"
 
+            # Only messages this browser tab hasn't shown yet, every tab keeps its own seq
+            new_messages = self.tester.data_storage.messages.since(seen_seq or 0)
             new_children = []
-            for msg in self.tester.data_storage.messages:
+            for msg in new_messages:
+                timestamp = f"[{msg.wall.strftime('%H:%M:%S')}]"
                 # Check if the message is an html.Div
-                if msg['color'] == "TEST RESULTS":
-                    # msg['text'] structure: [timestamp, p1_pass, p2_pass, p3_pass, scp_pass, test_valid, OPP_trips]
+                if msg.color == "TEST RESULTS":
+                    # msg.text structure: [p1_pass, p2_pass, p3_pass, scp_pass, test_valid, OPP_trips]
                     msg_style = {"color": LIGHT_BLUE, "fontSize": "13px"}
                     pass_style = {"fontSize": "13px", "font-weight": "bold"}
-                    timestamp, p1_pass, p2_pass, p3_pass, scp_pass, test_valid, OPP_trips = msg['text']
+                    p1_pass, p2_pass, p3_pass, scp_pass, test_valid, OPP_trips = msg.text
                     new_children.append(html.Div([
                         html.Span(timestamp, style={"color": "#888", "fontWeight": "bold", "fontSize": "13px", "margin-right": "25px"}),
                         html.Div([
@@ -720,22 +767,23 @@ class Dashboard(Dash):
                     ], className="fin-message"))
 
                 else:
-                    # Process the message as a string
-                    timestamp, message = msg["text"].split(";", 1)
-                    new_children.append(html.Div([
-                        html.Span(timestamp, style={"color": "#555", "fontWeight": "bold", "fontSize": "13px"}),
-                        html.Span(message, style={"color": msg["color"], "marginLeft": "5px", "fontSize": "13px"})
-                    ]))
+                    # Process the message as a string, multi line messages get one row per line
+                    for line in msg.text.split("\n"):
+                        new_children.append(html.Div([
+                            html.Span(timestamp, style={"color": "#555", "fontWeight": "bold", "fontSize": "13px"}),
+                            html.Span(line, style={"color": msg.color, "marginLeft": "5px", "fontSize": "13px"})
+                        ]))
 
-            combined_children = (current_children or []) + new_children
-            combined_children = combined_children[-250:]
-            self.tester.data_storage.messages.clear()
             if self.tester.update_ptd:
                 self.tester.update_ptd = False
                 tests = self.return_tests()
             else:
                 tests = no_update
-            return combined_children, btnclass, dd1, dd2, tests
+            if not new_messages:
+                return no_update, btnclass, dd1, dd2, tests, no_update
+            combined_children = (current_children or []) + new_children
+            combined_children = combined_children[-self.tester.data_storage.max_len:]
+            return combined_children, btnclass, dd1, dd2, tests, new_messages[-1].seq
 
         # Opening / Closing of the descriptions window
         @self.callback(
@@ -790,23 +838,23 @@ class Dashboard(Dash):
             State("max-current-input", "value"),
             State("safety-toggle", "value"),
             State("seconds-toggle", "value"),
-            State("resolution-toggle", "value"),
+            State("adc-mode-dropdown", "value"),
             State("phase-1-include", "value"),
             State("phase-1-repeat", "value"),
             State("phase-2-include", "value"),
             State("phase-2-repeat", "value"),
             State("phase-3-include", "value"),
             State("phase-3-repeat", "value"),
-            State("phase-3-opp", "value"),
+            State("phase-3-short-circuit", "value"),
             State("max-message-num", "value"),
             prevent_initial_call=True
         )
-        def toggle_sidebar(n_clicks, mcs_val, sf_val, ps_val, hr_val, p1incl_val, p1rep_val, p2incl_val, p2rep_val, p3incl_val, p3rep_val, p3opp_val, max_message):
+        def toggle_sidebar(n_clicks, mcs_val, sf_val, ps_val, adc_val, p1incl_val, p1rep_val, p2incl_val, p2rep_val, p3incl_val, p3rep_val, p3sc_val, max_message):
             if n_clicks:
-                res = self.tester.settings.new_values(mcs_val, sf_val, ps_val, hr_val,
+                res = self.tester.settings.new_values(mcs_val, sf_val, ps_val, adc_val,
                                                       p1incl_val == ["include"], p1rep_val,
                                                       p2incl_val == ["include"], p2rep_val,
-                                                      p3incl_val == ["include"], p3rep_val, p3opp_val)
+                                                      p3incl_val == ["include"], p3rep_val, p3sc_val)
                 try:
                     max_message = int(max_message)
                     if 99 > max_message > 5000:
@@ -818,13 +866,8 @@ class Dashboard(Dash):
                 if res["parsed"]:
                     self.tester.data_storage.add_message(res["msg"], GREEN)
                     self.tester.data_storage.clear()
-                    if self.tester.settings.high_res:
-                        self.tester.switch_to_high_res()
-                        return "freq-disabled"
-
-                    else:
-                        self.tester.switch_to_low_res()
-                        return "freq-enabled"
+                    self.tester.apply_adc_mode()
+                    return "freq-enabled"
 
                 else:
                     self.tester.data_storage.add_message(res["msg"], RED)
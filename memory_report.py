@@ -0,0 +1,89 @@
+import sys
+import numpy as np
+from acquisition import Bucket
+from sample_ring import SampleRing
+from subclasses import Adapter, DataStorage, EvaluateResults
+
+# python memory_report.py [test seconds], bytes per test-second of the sample and result containers,
+# the old per-sample lists / dicts against the typed rings and NaN masked arrays
+SAMPLES_PER_SECOND = 10  # 100ms buckets
+OOB_SHARE = 0.05  # Part of the samples out of bounds in the synthetic test
+
+
+def deep_size(obj, seen=None) -> int:
+    # sys.getsizeof of a container and everything in it, shared objects once
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(x, seen) for x in obj)
+    return size
+
+
+def synthetic_test(seconds: int):
+    n = seconds * SAMPLES_PER_SECOND
+    rng = np.random.default_rng(0)
+    voltage = (5 + rng.normal(0, 0.05, n)).astype(np.float32)
+    oob = rng.random(n) < OOB_SHARE
+    voltage[oob] = 4.2
+    load = np.repeat(np.arange(0, 101, 10), -(-n // 11))[:n].astype(np.uint16)
+    current = (load / 100 * 3).astype(np.float32)
+    timestamps = np.arange(n, dtype=np.int64) * 100_000_000
+    return voltage, current, load, timestamps, oob
+
+
+def old_containers(voltage, current, load, timestamps, oob) -> int:
+    # What the lists based storage and EvaluateResults kept per test, every value a boxed Python object
+    n = len(voltage)
+    p2_stop = n * 2 // 3
+    voltage, current, load, timestamps = voltage.tolist(), current.tolist(), load.tolist(), timestamps.tolist()
+    v_min, v_max = list(voltage), [v + 0.01 for v in voltage]
+    storage = [voltage, current, load, timestamps, v_min, v_max, [t / 1e9 for t in timestamps]]
+    results = [
+        [4.5 if i < p2_stop else None for i in range(n)],  # bottom_border
+        [5.5 if i < p2_stop else None for i in range(n)],  # top_border
+        [None if bad else v for v, bad in zip(voltage, oob)],  # voltage_good
+        [v if bad else None for v, bad in zip(voltage, oob)],  # voltage_oob
+        [1 if i < n // 3 else 2 if i < p2_stop else 3 for i in range(n)],  # phase
+        [{"voltage": v, "current": a, "load": l, "expected_min": 4.5, "expected_max": 5.5}
+         for v, a, l, bad in zip(voltage, current, load, oob) if bad],  # OOB_results
+    ]
+    return deep_size(storage) + deep_size(results)
+
+
+class _Results(EvaluateResults):
+    # Doesn't touch the id tracker, nothing is written
+    def load_id_tracker(self, file_name='id_tracker.pkl'):
+        pass
+
+
+def new_containers(voltage, current, load, timestamps) -> int:
+    n = len(voltage)
+    ring = SampleRing(n)
+    for i in range(n):
+        v = float(voltage[i])
+        ring.append(Bucket(int(timestamps[i]), v, v, v + 0.01, float(current[i]), float(current[i]), float(current[i]), 10), int(load[i]))
+    cols = ring.read(0, n)
+    test_values = [{"start_index": 0, "stop_index": n // 3}, {"start_index": n // 3, "stop_index": n * 2 // 3},
+                   {"start_index": n * 2 // 3, "stop_index": n, "OPP_trip_index": [], "OPP_trip_load": [], "short_circuit": True}]
+    results = _Results(DataStorage(capacity=16))
+    results.eval(cols[1], cols[2], cols[3], cols[0], cols[4], cols[5], test_values, Adapter("report", 3, 5, 5, 10, 90, 110))
+    # The trimmed channels are views into the ring, only what eval allocated on top of it counts
+    arrays = [results.bottom_border, results.top_border, results.voltage_good, results.voltage_oob, results.phase, results.OOB_results]
+    own = [a for a in (results.voltage, results.current, results.load, results.v_min, results.v_max, results.time) if a.base is None]
+    return sum(col.nbytes for col in ring.columns) + sum(a.nbytes for a in arrays + own)
+
+
+if __name__ == "__main__":
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    voltage, current, load, timestamps, oob = synthetic_test(seconds)
+    old = old_containers(voltage, current, load, timestamps, oob)
+    new = new_containers(voltage, current, load, timestamps)
+    print(f"{seconds} s test, {len(voltage)} samples, {np.count_nonzero(oob)} out of bounds")
+    print(f"Lists and dicts:   {old / seconds:10.0f} B per test-second  ({old / 2 ** 20:.1f} MiB)")
+    print(f"Rings and arrays:  {new / seconds:10.0f} B per test-second  ({new / 2 ** 20:.1f} MiB)")
+    print(f"{old / new:.1f}x smaller")
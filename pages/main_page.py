@@ -2,6 +2,7 @@ from dash import Dash, html, dcc, Input, Output, State, callback_context, no_upd
     get_app, get_asset_url
 from colors import BLACK, WHITE, GRAY, RED, GREEN, ORANGE, BLUE, LIGHT_BLUE, YELLOW
 from subclasses import empty_fig
+from ina219_reader import ADC_MODES, conversion_time
 import dash_daq as daq
 
 app = get_app()
@@ -53,6 +54,8 @@ register_page(
                 dcc.Store(id="data-store"),
                 dcc.Store(id="pause-state", data=False),
                 dcc.Interval(id="graph-interval", interval=1000),
+                dcc.Store(id="connection-version"),
+                dcc.Interval(id="connection-interval", interval=250),
                 html.Div([
                     html.Div([], id="Adapter-connection-status", className="adapter-connection-status disconnected", title="Green = Adapter connected, Red = Adapter disconnected"),
                     html.Div([
@@ -66,6 +69,7 @@ register_page(
             ], className="graph-container", id="graph-container"),
             # CMD section
             dcc.Interval(id="cmd-interval", interval=1000),
+            dcc.Store(id="cmd-seq", data=0),  # Seq of the last message this tab has shown
             html.Div([], className="cmd", id="cmd"),
         ], className="graph-cmd-container", id="graph-cmd-container"),
 
@@ -332,11 +336,10 @@ register_page(
                         html.Span("Stop test", className="toggle-label-right", title="Test ends with an error message"),
                     ], className="toggle-wrapper"), html.Br(),
 
-                    html.Div([
-                        html.Span("Low resolution", className="toggle-label-left", title="9BIT measurements, max 10x a second"),
-                        daq.ToggleSwitch(id='resolution-toggle', value=app.tester.settings.high_res, label='Resolution Mode', labelPosition='top'),
-                        html.Span("High resolution", className="toggle-label-right", title="12BIT measurements, only 2x a second"),
-                    ], className="toggle-wrapper"),html.Br(),
+                    html.Label("ADC mode (resolution / averaged samples):", title="More averaging = less noise but fewer raw samples per second"),
+                    dcc.Dropdown(id="adc-mode-dropdown", options=[{"label": f"{mode} ({conversion_time(mode) * 1000:.2f}ms)", "value": mode} for mode in ADC_MODES],
+                                 value=app.tester.settings.adc_mode, clearable=False, className="dropdown"),
+                    html.Br(),
 
                     html.Div([
                         html.Div([
@@ -344,7 +347,7 @@ register_page(
                             daq.ToggleSwitch(id="seconds-toggle", value=app.tester.settings.per_sec, label="Graph Data Mode", labelPosition="top"),
                             html.Span("1x per second", className="toggle-label-right", title="Data is measured 1x a second, slowest setting"),
                         ], className="toggle-wrapper"),
-                        html.Div(className="freq-disabled" if app.tester.settings.high_res else "freq-enabled", id="overlay-seconds-toggle"), html.Br(),
+                        html.Div(className="freq-enabled", id="overlay-seconds-toggle"), html.Br(),
                     ], className="freq-wrapper"),
 
                 ], className="general-settings"),html.Br(),
@@ -369,8 +372,8 @@ register_page(
                         dcc.Checklist(options=[{"label": "Include", "value": "include"}], value=["include"] if app.tester.settings.phase3[0] else [], id="phase-3-include"),
                         html.Label("Repeat x times:"),
                         dcc.Input(id="phase-3-repeat", className="in", type="number", value=app.tester.settings.phase3[1], step=1, min=1, max=5),
-                        html.Label("Look for OPP trip point x times:"),
-                        dcc.Input(id="phase-3-opp", className="in", type="number", value=app.tester.settings.phase3[2], step=1, min=1, max=10),
+                        html.Label("Short circuit tries:"),
+                        dcc.Input(id="phase-3-short-circuit", className="in", type="number", value=app.tester.settings.phase3[2], step=1, min=1, max=10),
                         html.Br()
                     ], className="phase"),
                 ], className="phases-settings"),
@@ -168,17 +168,16 @@ def manage_ripple_tests(n_clicks, intervals, del_clicks, conf_exit, conf_del, cu
         def_return[0] = combined_children
 
         if app.ripple_tester.is_running:
-            if app.ripple_tester.timer >= app.ripple_tester.timer_max:
+            if app.ripple_tester.is_time_up():
                 # The time has elapsed
                 msg = "Data gathered, processing results please wait ..."
                 app.ripple_tester.add_message(msg, GREEN)
                 print(colorama.Fore.GREEN, msg, colorama.Fore.RESET)
-                app.ripple_tester.stop(app.tester.data_storage.voltage[-100:])
+                app.ripple_tester.stop(app.tester.data_storage.snapshot().voltage[-100:])
                 return def_return
 
             else:
                 # Still gathering data
-                app.ripple_tester.timer += 1
                 def_return[8] = {"width": f"{(100 * app.ripple_tester.timer) / app.ripple_tester.timer_max}%"}
                 msg = f"Time: {app.ripple_tester.timer}"
                 print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
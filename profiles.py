@@ -0,0 +1,137 @@
+import json
+import numpy as np
+from sample_ring import MAX_LOAD
+
+PROFILE_FILE = "profiles.json"
+
+# Kinds of schedule rows
+HOLD = 0  # Load for a time, samples aren't counted (settling, rests)
+DWELL = 1  # Load until this many samples were stored at it, these are the samples the phases are evaluated on
+OPP_SEARCH = 2  # Phase 3 over-power bisection, parameters in TestProfile.opp
+SHORT_CIRCUIT = 3  # Phase 3 short circuit tries, parameters in TestProfile.short_circuit
+
+# One row per step of the test, start / stop are the sample indices the scheduler ran it between, -1 until it ran.
+# used is the number of samples a dwell took at its load, fewer than samples if the adaptive dwell ended it early
+SCHEDULE = np.dtype([("phase", "i1"), ("kind", "i1"), ("load", "u2"), ("samples", "i4"), ("seconds", "f4"), ("start", "i8"), ("stop", "i8"),
+                     ("used", "i4")])
+
+OPP_KEYS = ("step_up", "resolution", "probe", "recovery", "recovery_hold", "max_trips", "timeout")
+SHORT_CIRCUIT_KEYS = ("hold", "recovery")
+# Adaptive dwell of a phase: confidence of the estimates, tolerance of the mean voltage in % of the nominal one, least samples per dwell
+ADAPTIVE_KEYS = ("confidence", "tolerance", "min_samples")
+
+
+class TestProfile:
+    # What a test does, loaded from profiles.json and checked once, compiled into a schedule for every test
+    def __init__(self, name: str, data: dict):
+        self.name = name
+        self.description = {}  # phase: [lines]
+        self.settle = {}  # phase: (load, seconds) before the repeats
+        self.steps = {}  # phase: [(load, samples or None, seconds)], samples None means seconds of samples
+        self.rest = {}  # phase: (load, seconds) after every repeat
+        self.adaptive = {}  # phase: {ADAPTIVE_KEYS}, its dwells end once the voltage settled, the step's samples are the most it waits
+        for phase in (1, 2):
+            p = self._get(data, f"phase{phase}", dict)
+            self.description[phase] = self._lines(p, phase)
+            if "loads" in p:
+                steps = [dict(load=load, **{k: p[k] for k in ("seconds", "samples") if k in p}) for load in self._get(p, "loads", list)]
+            else:
+                steps = self._get(p, "steps", list)
+            if not steps:
+                raise ValueError(f"Profile {name}: phase {phase} has no steps")
+            self.steps[phase] = [self._dwell(step, phase) for step in steps]
+            for key, target in (("settle", self.settle), ("rest", self.rest)):
+                if key in p:
+                    load, _, seconds = self._dwell(p[key], phase, timed=True)
+                    target[phase] = (load, seconds)
+            if "adaptive" in p:
+                self.adaptive[phase] = self._adaptive(self._get(p, "adaptive", dict), phase)
+        p = self._get(data, "phase3", dict)
+        self.description[3] = self._lines(p, 3)
+        self.opp = self._numbers(self._get(p, "opp", dict), OPP_KEYS, "opp")
+        self.short_circuit = self._numbers(self._get(p, "short_circuit", dict), SHORT_CIRCUIT_KEYS, "short_circuit")
+
+    def _get(self, data: dict, key: str, kind: type):
+        if not isinstance(data.get(key), kind):
+            raise ValueError(f"Profile {self.name}: '{key}' missing or not a {kind.__name__}")
+        return data[key]
+
+    def _lines(self, p: dict, phase: int) -> [str]:
+        lines = p.get("description", [f"Phase {phase}"])
+        return [lines] if isinstance(lines, str) else list(lines)
+
+    def _dwell(self, step: dict, phase: int, timed: bool = False) -> (int, int, float):
+        load = step.get("load")
+        if not isinstance(load, int) or not 0 <= load < MAX_LOAD:
+            raise ValueError(f"Profile {self.name}: phase {phase} load {load!r} must be a whole % between 0 and {MAX_LOAD - 1}")
+        samples, seconds = step.get("samples"), step.get("seconds")
+        if timed or samples is None:
+            if not isinstance(seconds, (int, float)) or seconds <= 0:
+                raise ValueError(f"Profile {self.name}: phase {phase} step at {load}% needs a positive 'seconds'" + ("" if timed else " or 'samples'"))
+            return load, None, float(seconds)
+        if not isinstance(samples, int) or samples <= 0:
+            raise ValueError(f"Profile {self.name}: phase {phase} step at {load}% needs a positive whole 'samples'")
+        return load, samples, 0.0
+
+    def _numbers(self, data: dict, keys: (str,), what: str) -> dict:
+        for key in keys:
+            if not isinstance(data.get(key), (int, float)) or data[key] < 0:
+                raise ValueError(f"Profile {self.name}: {what} '{key}' missing or negative")
+        return {key: data[key] for key in keys}
+
+    def _adaptive(self, data: dict, phase: int) -> dict:
+        adaptive = self._numbers(data, ADAPTIVE_KEYS, f"phase{phase} adaptive")
+        if not 0 < adaptive["confidence"] < 1:
+            raise ValueError(f"Profile {self.name}: phase{phase} adaptive 'confidence' must be between 0 and 1")
+        if not isinstance(adaptive["min_samples"], int) or adaptive["min_samples"] < 2:
+            raise ValueError(f"Profile {self.name}: phase{phase} adaptive 'min_samples' must be a whole number of at least 2")
+        return adaptive
+
+    def compile(self, phase1: list, phase2: list, phase3: list, samples_for) -> np.ndarray:
+        # Flat schedule for one test, the settings' [include, repeats, ...] per phase, samples_for(seconds) converts dwell times to samples
+        rows = []
+        for phase, (include, repeats, *_) in ((1, phase1), (2, phase2)):
+            if not include:
+                continue
+            if phase in self.settle:
+                load, seconds = self.settle[phase]
+                rows.append((phase, HOLD, load, 0, seconds, -1, -1, -1))
+            for _ in range(repeats):
+                for load, samples, seconds in self.steps[phase]:
+                    rows.append((phase, DWELL, load, samples or samples_for(seconds), seconds, -1, -1, -1))
+                if phase in self.rest:
+                    load, seconds = self.rest[phase]
+                    rows.append((phase, HOLD, load, 0, seconds, -1, -1, -1))
+        if phase3[0]:
+            rows += [(3, OPP_SEARCH, 0, 0, 0, -1, -1, -1)] * phase3[1]
+            rows.append((3, SHORT_CIRCUIT, 0, 0, 0, -1, -1, -1))
+        return np.array(rows, dtype=SCHEDULE)
+
+
+def load_profiles(path: str = PROFILE_FILE) -> ({str: TestProfile}, str, [str]):
+    # (profiles, name of the default one, errors), a profile that doesn't check out is left out with an error
+    with open(path, "r") as f:
+        data = json.load(f)
+    profiles, errors = {}, []
+    for name, profile in data.get("profiles", {}).items():
+        try:
+            profiles[name] = TestProfile(name, profile)
+        except ValueError as e:
+            errors.append(str(e))
+    default = data.get("default", "standard")
+    if default not in profiles:
+        errors.append(f"Default profile {default} isn't defined")
+        default = next(iter(profiles), None)
+    return profiles, default, errors
+
+
+def phase_rows(schedule: np.ndarray, phase: int) -> np.ndarray:
+    return np.flatnonzero(schedule["phase"] == phase)
+
+
+def phase_bounds(schedule: np.ndarray, phase: int) -> (int, int):
+    # [start, stop) sample indices of the dwells of a phase, the samples it is evaluated on. (0, 0) if it didn't run
+    dwells = schedule[(schedule["phase"] == phase) & (schedule["kind"] == DWELL) & (schedule["stop"] >= 0)]
+    if not len(dwells):
+        return 0, 0
+    return int(dwells["start"][0]), int(dwells["stop"][-1])
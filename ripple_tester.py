@@ -7,13 +7,15 @@ import threading
 import zipfile
 from datetime import datetime
 from dash import dcc, register_page, html, get_app, Output, Input, no_update
+from hardware import RealClock
 from colors import BLACK, WHITE, GRAY, RED, GREEN, ORANGE, BLUE, LIGHT_BLUE, YELLOW
 import numpy as np
 import h5py
 import plotly.graph_objects as go
 
 class RippleTester:
-    def __init__(self):
+    def __init__(self, clock=None):
+        self.clock = clock or RealClock()  # The tester's clock, so the test length runs on the same time as the samples
         self.voltage = []
         self.expected_voltage: float = 0.0
         self.tolerance: float = 0.0
@@ -31,7 +33,8 @@ class RippleTester:
         self.is_running: bool = False
         self.is_waiting_to_display: bool = False
         self.timer_max: int = 0
-        self.timer: int = 0
+        self.timer: int = 0  # Whole seconds elapsed, for the progress bar
+        self.start_ns: int = 0
         self.graph_data = {
             "v_ok": [],
             "v_oob": [],
@@ -57,12 +60,21 @@ class RippleTester:
         except TypeError:
             return False
 
+        self.start_ns = self.clock.now_ns()
         self.is_running = True
         return True
 
+    def elapsed(self) -> float:
+        return (self.clock.now_ns() - self.start_ns) / 1e9
+
+    def is_time_up(self) -> bool:
+        self.timer = min(int(self.elapsed()), self.timer_max)
+        return self.elapsed() >= self.timer_max
+
     def stop(self, v: [float]):
         self.timer = 0
-        self.voltage = v
+        # A copy as Python floats, a ring view would be overwritten once the ring comes around and float32 isn't JSON serializable
+        self.voltage = np.asarray(v, dtype=float).tolist()
         self.process_thread = threading.Thread(target=self.run_test_analysis)
         self.process_thread.start()
 
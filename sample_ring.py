@@ -0,0 +1,180 @@
+import bisect
+import numpy as np
+from collections import namedtuple
+from multiprocessing import shared_memory
+from acquisition import Bucket
+
+# Columns of one stored sample, same order as subclasses.Snapshot
+FIELDS = (
+    ("timestamps", np.int64),  # Start of the bucket in ns
+    ("voltage", np.float32),  # Bucket means
+    ("current", np.float32),
+    ("load", np.uint16),  # Whole %, MAX_LOAD marks the short circuit test
+    ("v_min", np.float32),
+    ("v_max", np.float32),
+    ("c_min", np.float32),
+    ("c_max", np.float32),
+    ("counts", np.int32),  # Raw samples in the bucket
+)
+LOAD_COLUMN = [name for name, _ in FIELDS].index("load")
+MAX_LOAD = 0xFFFF
+HEADER_SIZE = 64  # Bytes, first int64 is the number of samples ever written
+
+
+class SampleRing:
+    # Fixed size ring of buckets, one writer, any number of readers, optionally in shared memory so the writer can be another process.
+    # Samples are addressed by how many were written before them, a slot gets reused once capacity newer samples exist
+    def __init__(self, capacity: int = 65536, shared: bool = False):
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * sum(np.dtype(dtype).itemsize for _, dtype in FIELDS)
+        self.shm = shared_memory.SharedMemory(create=True, size=size) if shared else None
+        buf = self.shm.buf if shared else bytearray(size)
+        self.header = np.ndarray((HEADER_SIZE // 8,), dtype=np.int64, buffer=buf)
+        self.header[:] = 0
+        self.columns = []
+        offset = HEADER_SIZE
+        for name, dtype in FIELDS:
+            col = np.ndarray((capacity,), dtype=dtype, buffer=buf, offset=offset)
+            setattr(self, name, col)
+            self.columns.append(col)
+            offset += col.nbytes
+
+    @property
+    def count(self) -> int:
+        return int(self.header[0])
+
+    def append(self, b: Bucket, load: float, connected: bool = True):
+        if not connected:
+            # Nothing to measure, keep the time and sample count only
+            b = Bucket(b.t, 0, 0, 0, 0, 0, 0, b.count)
+            load = 0
+        n = int(self.header[0])
+        i = n % self.capacity
+        self.timestamps[i] = b.t
+        self.voltage[i] = b.v_mean
+        self.current[i] = b.a_mean
+        self.load[i] = min(round(load), MAX_LOAD)
+        self.v_min[i] = b.v_min
+        self.v_max[i] = b.v_max
+        self.c_min[i] = b.a_min
+        self.c_max[i] = b.a_max
+        self.counts[i] = b.count
+        # Publish last, readers never look past the count
+        self.header[0] = n + 1
+
+    def read(self, start: int, stop: int) -> [np.ndarray]:
+        # Read-only columns for samples [start, stop), views into the ring unless the range wraps around its end
+        start = max(start, stop - self.capacity, 0)
+        if stop <= start:
+            cols = [col[:0] for col in self.columns]
+        else:
+            i, j = start % self.capacity, stop % self.capacity
+            if i < j or j == 0:
+                cols = [col[i:j or self.capacity] for col in self.columns]
+            else:
+                cols = [np.concatenate((col[i:], col[:j])) for col in self.columns]
+        for col in cols:
+            col.flags.writeable = False
+        return cols
+
+    def resized(self, capacity: int) -> "SampleRing":
+        # Local copy with another capacity holding the newest samples under the same indices, only the writer may call this
+        ring = SampleRing(capacity)
+        n = self.count
+        start = max(0, n - min(capacity, self.capacity))
+        slots = np.arange(start, n) % capacity
+        for new, old in zip(ring.columns, self.read(start, n)):
+            new[slots] = old
+        ring.header[0] = n
+        return ring
+
+    def at(self, n: int, col: np.ndarray):
+        return col[n % self.capacity]
+
+    def close(self):
+        if self.shm is not None:
+            # Views into the buffer have to go before the mapping can be closed
+            self.header = None
+            self.columns = []
+            for name, _ in FIELDS:
+                setattr(self, name, None)
+            self.shm.close()
+
+    def unlink(self):
+        if self.shm is not None:
+            self.shm.unlink()
+
+
+# One run of samples at the same load, [start, stop) sample indices, t is the timestamp of the first sample
+Segment = namedtuple("Segment", ["level", "start", "stop", "t"])
+
+
+class LoadSegments:
+    # Run-length index of the load channel, fed with the new samples of a ring so keeping it up to date is O(1) per sample.
+    # Answers how many samples were taken at a load level and where the load steps start and stop without scanning the samples
+    def __init__(self, start: int = 0):
+        self.start = start  # Ring index of the first indexed sample, index 0 for the DataStorage
+        self.seen = start  # Ring index of the next sample to index
+        self.segments: [[int]] = []  # [level, first, stop, t], [first, stop) in ring indices, the last one grows with the samples
+        self.starts: [int] = []  # First index of each segment
+        self.totals = {}  # level: samples
+        self.by_level = {}  # level: ([first index of each segment at that level], [samples at that level before it], [segments])
+
+    def update(self, ring: SampleRing):
+        end = ring.count
+        if end <= self.seen:
+            return
+        # Samples the ring already reused are gone, continue from the oldest one still there
+        self.seen = max(self.seen, end - ring.capacity)
+        columns = ring.read(self.seen, end)
+        load, timestamps = columns[LOAD_COLUMN], columns[0]
+        # Indices where the level changes, only the runs get looked at in Python
+        cuts = (np.flatnonzero(load[1:] != load[:-1]) + 1).tolist()
+        for first, stop in zip([0] + cuts, cuts + [len(load)]):
+            self._add(int(load[first]), self.seen + first, self.seen + stop, int(timestamps[first]))
+        self.seen = end
+
+    def _add(self, level: int, first: int, stop: int, t: int):
+        last = self.segments[-1] if self.segments else None
+        if last is not None and last[0] == level and last[2] == first:
+            last[2] = stop
+        else:
+            segment = [level, first, stop, t]
+            starts, before, segments = self.by_level.setdefault(level, ([], [], []))
+            starts.append(first)
+            before.append(self.totals.get(level, 0))
+            segments.append(segment)
+            self.segments.append(segment)
+            self.starts.append(first)
+        self.totals[level] = self.totals.get(level, 0) + stop - first
+
+    def count(self, level: int, start: int = None) -> int:
+        # Samples at this level from ring index start on, O(log segments at that level)
+        total = self.totals.get(level, 0)
+        if start is None or not total:
+            return total
+        starts, before, segments = self.by_level[level]
+        j = bisect.bisect_right(starts, start) - 1
+        if j < 0:
+            return total
+        # The segment starting last before start may still cover it
+        return total - before[j] - (min(segments[j][2], start) - starts[j])
+
+    def find(self, start: int, loaded: bool) -> int:
+        # First ring index from start on with a load (loaded) or without one, None if there is none yet
+        j = max(0, bisect.bisect_right(self.starts, start) - 1)
+        for level, first, stop, t in self.segments[j:]:
+            if stop > start and (level > 0) == loaded:
+                return max(first, start)
+        return None
+
+    def between(self, first: int, stop: int) -> [Segment]:
+        # Segments overlapping [first, stop), cut to it, t stays the time the whole segment started
+        j = max(0, bisect.bisect_right(self.starts, first) - 1)
+        res = []
+        for level, seg_first, seg_stop, t in self.segments[j:]:
+            if seg_first >= stop:
+                break
+            if seg_stop > first:
+                res.append(Segment(level, max(seg_first, first), min(seg_stop, stop), t))
+        return res
@@ -0,0 +1,152 @@
+import multiprocessing
+import numpy as np
+import colorama
+from multiprocessing import shared_memory
+from acquisition import Sampler
+from ina219_reader import ADC_MODES
+from sample_ring import SampleRing
+
+# Slots of the shared control block, written by the main process
+LOAD = 0
+CONNECTED = 1
+STOP = 2
+ADC_MODE = 3  # Index into ADC_MODES
+RAW_PERIOD = 4
+DEBUG = 5
+# Written by the sampler process
+VOLTAGE = 8
+CURRENT = 9
+ACHIEVED_RATE = 10
+OVERRUNS = 11
+DROPPED_SAMPLES = 12
+CONTROL_SLOTS = 16
+
+MODE_NAMES = list(ADC_MODES)
+
+
+class SamplerProcess:
+    # Runs the Sampler in its own process so UI work in the main process can't delay raw reads.
+    # Buckets go straight into shared memory rings the DataStorage reads, load / connection state and stats go through a small control block.
+    # Same attributes as acquisition.Sampler, so the tester uses either one the same way
+    def __init__(self, backend, bucket_period: float = 0.1, capacity: int = 65536, second_capacity: int = 4096):
+        self.backend = backend
+        self.bucket_period = bucket_period
+        self.samples = SampleRing(capacity, shared=True)  # 100ms buckets
+        self.seconds = SampleRing(second_capacity, shared=True)  # 1s buckets
+        self._control_shm = shared_memory.SharedMemory(create=True, size=CONTROL_SLOTS * 8)
+        self.control = np.ndarray((CONTROL_SLOTS,), dtype=np.float64, buffer=self._control_shm.buf)
+        self.control[:] = 0
+        self.process = None
+
+    @property
+    def load(self) -> float:
+        return float(self.control[LOAD])
+
+    @load.setter
+    def load(self, value: float):
+        self.control[LOAD] = value
+
+    @property
+    def connected(self) -> bool:
+        return bool(self.control[CONNECTED])
+
+    @connected.setter
+    def connected(self, value: bool):
+        self.control[CONNECTED] = value
+
+    @property
+    def debug(self) -> bool:
+        return bool(self.control[DEBUG])
+
+    @debug.setter
+    def debug(self, value: bool):
+        self.control[DEBUG] = value
+
+    @property
+    def raw_period(self) -> float:
+        return float(self.control[RAW_PERIOD])
+
+    @property
+    def voltage(self) -> float:
+        return float(self.control[VOLTAGE])
+
+    @property
+    def current(self) -> float:
+        return float(self.control[CURRENT])
+
+    @property
+    def achieved_rate(self) -> float:
+        return float(self.control[ACHIEVED_RATE])
+
+    @property
+    def overruns(self) -> int:
+        return int(self.control[OVERRUNS])
+
+    @property
+    def dropped_samples(self) -> int:
+        return int(self.control[DROPPED_SAMPLES])
+
+    def set_adc_mode(self, mode: str, raw_period: float):
+        # Picked up by the sampler process at the next bucket
+        self.control[RAW_PERIOD] = raw_period
+        self.control[ADC_MODE] = MODE_NAMES.index(mode)
+
+    def start(self):
+        # Forked, the child inherits the backend and the shared mappings, the Pi backend couldn't be pickled for spawn anyway.
+        # Start it before other threads exist, only the forking thread is copied into the child
+        ctx = multiprocessing.get_context("fork")
+        self.process = ctx.Process(target=self._run, name="sampler", daemon=True)
+        self.process.start()
+
+    def _run(self):
+        # Sampler process
+        sampler = Sampler(self.bucket_period)
+        sampler.reader = self.backend.create_sensor()
+        mode = int(self.control[ADC_MODE])
+        sampler.set_adc_mode(MODE_NAMES[mode], self.raw_period)
+        control = self.control
+        buckets = 0
+
+        def on_bucket(bucket):
+            nonlocal mode, buckets
+            if control[STOP]:
+                sampler.stop()
+            if int(control[ADC_MODE]) != mode:
+                mode = int(control[ADC_MODE])
+                sampler.set_adc_mode(MODE_NAMES[mode], float(control[RAW_PERIOD]))
+            self.samples.append(bucket, float(control[LOAD]), bool(control[CONNECTED]))
+            control[VOLTAGE] = sampler.voltage
+            control[CURRENT] = sampler.current
+            control[ACHIEVED_RATE] = sampler.achieved_rate
+            control[OVERRUNS] = sampler.overruns
+            control[DROPPED_SAMPLES] = sampler.dropped_samples
+            if control[DEBUG] and buckets % 10 == 0:
+                msg = f"Sampler process: {bucket.v_mean}V ({bucket.v_min} - {bucket.v_max}V); {bucket.a_mean}A; " \
+                      f"Raw rate: {sampler.achieved_rate:.2f} Hz; Samples in bucket: {bucket.count}; " \
+                      f"Overruns: {sampler.overruns}; Dropped: {sampler.dropped_samples}"
+                print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
+            buckets += 1
+
+        def on_second(second):
+            self.seconds.append(second, float(control[LOAD]), bool(control[CONNECTED]))
+
+        sampler.run(self.backend.clock, on_bucket, on_second)
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.control[STOP] = 1
+        self.process.join(2)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process = None
+
+    def close(self):
+        # Only after stop() and once nothing reads the rings any more
+        for ring in (self.samples, self.seconds):
+            ring.close()
+            ring.unlink()
+        self.control = None
+        self._control_shm.close()
+        self._control_shm.unlink()
@@ -0,0 +1,217 @@
+import argparse
+import shutil
+import sys
+from time import perf_counter
+import colorama
+import h5py
+from hardware import SimulatedBackend
+from journal import SampleJournal, recover, recovered_schedule, recovered_test_values
+from profiles import DWELL
+from subclasses import TestableAdapters
+from tester import FAIL_FAST, Tester
+
+# python simulate.py [profile ...] [--speed 100] [--runs 1] [--adapter name ...] [--opp 130] [--fail-fast criterion ...]
+#                    [--skip-phase 1 ...] [--crash seconds]
+# Runs complete tests against the simulated adapter on a virtual clock, everything the test does (sequencing, evaluation,
+# the test file) is the real code, only the hardware and the time are simulated. Prints the time every profile
+# would take on the real tester and exits with 1 if a test failed or didn't run through, so sequencing changes can be checked in seconds.
+# Several adapters are tested back to back on one tester like at the station, each one starts with a constant load check
+# that the load is converted for it and not for the adapter tested before. With --crash every test crashes that many seconds in,
+# the journal it leaves is recovered into a test file and its phases are checked against the steps that ran
+CHECKS = ("Phase 1", "Phase 2", "Phase 3", "Short circuit", "Valid")  # fin_message order
+SIM_READS_PER_SECOND = 5000  # Real sensor reads per second the simulation can keep up with, the raw sample rate is capped to it
+
+
+class SimulatedTester(Tester):
+    # Keeps what every finished test left behind, finish_test replaces the results with a fresh EvaluateResults
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.finished = []  # (results, test_values, schedule)
+
+    def finish_test(self):
+        self.finished.append((self.results, self.test_values, self.schedule))
+        super().finish_test()
+
+
+def run_test(tester: SimulatedTester, profile: str) -> dict:
+    finished = len(tester.finished)
+    wall = perf_counter()
+    tester.start(profile)
+    if tester.test_thread is None:
+        return None
+    tester.test_thread.join()
+    tester.test_thread = None
+    # The test file is written on the results worker, whatever is queued before this is done when it returns
+    tester.results_worker.submit(lambda: None).result()
+    run = {"profile": profile, "wall": perf_counter() - wall, "test_time": 0.0}
+    if len(tester.finished) == finished:
+        run["passed"] = False
+        run["error"] = tester.engine.token.reason or "Stopped"
+        run["test_time"] = sum(tester.engine.state_times.values())
+        return run
+    results, test_values, schedule = tester.finished[-1]
+    run["passed"] = all(results.fin_message[:5])
+    run["failed"] = [check for check, ok in zip(CHECKS, results.fin_message) if not ok]
+    # Time on the test clock is what the test takes on the tester, evaluating and writing the file is real time and mostly in the background
+    run["states"] = results.state_times
+    run["test_time"] = sum(results.state_times.values())
+    run["indices"] = [(v["start_index"], v["stop_index"]) for v in test_values]
+    run["opp"] = test_values[2]["OPP_trip_load"]
+    run["file"] = results.file_name
+    if results.fail_fast:
+        run["fail_fast"] = f"{results.fail_fast}, skipped phases {results.skipped or '-'}, an estimated {results.time_saved:.0f}s saved"
+    not_run = schedule[schedule["stop"] < 0]
+    if len(not_run) and not results.fail_fast:
+        run["passed"] = False
+        run["error"] = f"{len(not_run)} schedule step(s) didn't run"
+    run["dwells"] = int(((schedule["kind"] == DWELL) & (schedule["stop"] >= 0)).sum())
+    return run
+
+
+def crash_test(tester: SimulatedTester, profile: str, seconds: float) -> dict:
+    # The journal as a crash would leave it is a copy taken between two syncs, the test itself is stopped normally
+    wall = perf_counter()
+    tester.start(profile)
+    if tester.test_thread is None:
+        return None
+    tester.clock.sleep(seconds)
+    with tester._journal_lock:
+        path = tester.journal.path.replace(".journal", "-crash.journal") if tester.journal is not None else None
+        if path is not None:
+            shutil.copyfile(tester.journal.path, path)
+    tester.stop(False)
+    tester.test_thread.join()
+    tester.test_thread = None
+    run = {"profile": f"{profile} crashed after {seconds:g} s", "wall": perf_counter() - wall, "test_time": seconds, "passed": False}
+    if path is None:
+        run["error"] = "The test was over before the crash"
+        return run
+
+    journal = SampleJournal(path, create=False)
+    schedule = recovered_schedule(journal)
+    test_values = recovered_test_values(journal, schedule)
+    included = [phases[0] for phases in journal.meta["phases"]]
+    n, load = journal.count, journal.records["load"][:journal.count].copy()
+    journal.close()
+    errors = []
+    for phase in (1, 2):
+        bounds = (test_values[phase - 1]["start_index"], test_values[phase - 1]["stop_index"])
+        # Up to the last step of the phase that ran through, an excluded phase or one that never started has no samples
+        done = schedule[(schedule["phase"] == phase) & (schedule["kind"] == DWELL) & (schedule["stop"] >= 0)]
+        expected_stop = int(done["stop"][-1]) if included[phase - 1] and len(done) else 0
+        if bounds[1] != expected_stop or not 0 <= bounds[0] <= bounds[1] or (bounds[1] and load[bounds[0]] == 0 and done["load"][0] > 0):
+            errors.append(f"phase {phase} recovered as {bounds}, its steps ran up to {expected_stop}")
+    if test_values[2]["stop_index"] != n:
+        errors.append(f"phase 3 recovered up to {test_values[2]['stop_index']} of {n} samples")
+    run["file"] = recover(path)
+    with h5py.File(f"tests/{run['file']}", "r") as f:
+        details = f["Test_Details"].attrs
+        for phase in (1, 2):
+            if not included[phase - 1] and not details[f"Phase{phase}_Passed"]:
+                errors.append(f"excluded phase {phase} written as failed")
+    run["indices"] = [(v["start_index"], v["stop_index"]) for v in test_values]
+    run["passed"] = not errors
+    if errors:
+        run["error"] = ", ".join(errors)
+    return run
+
+
+def plug_in(tester: SimulatedTester, adapter):
+    # The simulated adapter is rated like the tested one, the rest of it stays
+    tester.backend.adapter.nominal_voltage, tester.backend.adapter.max_current = adapter.max_voltage, adapter.max_current
+    tester.testable_adapters.select_adapter(tester.testable_adapters.adapters.index(adapter))
+    # Samples of the plug-in aren't part of the first test
+    tester.clock.sleep(1)
+
+
+def check_constant_load(tester: SimulatedTester) -> dict:
+    # Half the selected adapter's rating as a constant load, the PWM has to get the duty the calibration gives for this adapter
+    adapter = tester.testable_adapters.selected_adapter
+    amps = adapter.max_current / 2
+    expected, _ = tester.settings.calibration.duty(amps / adapter.max_current * 100, adapter.max_current)
+    wall = perf_counter()
+    tester.start_constant_load(amps)
+    tester.clock.sleep(.5)
+    applied = tester.applied_pwm_duty
+    tester.stop(False)
+    tester.test_stopped()
+    run = {"profile": f"Constant load {amps:g} A", "adapter": adapter.name, "wall": perf_counter() - wall, "test_time": .5,
+           "passed": abs(applied - expected) < 1e-9}
+    if not run["passed"]:
+        run["error"] = f"PWM duty {applied:.2f}, the calibration gives {expected:.2f}"
+    return run
+
+
+def report(run: dict):
+    color = colorama.Fore.GREEN if run["passed"] else colorama.Fore.RED
+    print(color, f"{run['adapter']}, {run['profile']}: {'PASS' if run['passed'] else 'FAIL'}, test time {run['test_time']:.1f} s "
+                 f"({run['wall']:.1f} s wall)", colorama.Fore.RESET)
+    if "error" in run:
+        print(colorama.Fore.RED, f"    {run['error']}", colorama.Fore.RESET)
+    if run.get("failed"):
+        print(colorama.Fore.RED, f"    Failed: {', '.join(run['failed'])}", colorama.Fore.RESET)
+    if "fail_fast" in run:
+        print(colorama.Fore.RED, f"    {run['fail_fast']}", colorama.Fore.RESET)
+    if "states" in run:
+        print("    " + ", ".join(f"{state} {seconds:.1f} s" for state, seconds in run["states"].items()))
+        print(f"    Phase sample indices {run['indices']}, {run['dwells']} dwells, OPP trips at {run['opp']} %")
+        print(f"    tests/{run['file']}")
+    elif "file" in run:
+        print(f"    Recovered phase sample indices {run['indices']}, tests/{run['file']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run tests on the simulated adapter faster than real time")
+    parser.add_argument("profiles", nargs="*", help="Profiles from profiles.json, the default one if none are given")
+    parser.add_argument("--speed", type=float, default=100, help="Times faster than real time")
+    parser.add_argument("--runs", type=int, default=1, help="Tests per profile")
+    parser.add_argument("--adapter", nargs="+", help="Adapters from adapters.json tested one after the other, the first one if not given")
+    parser.add_argument("--opp", type=float, help="Load in %% the simulated adapter trips at, conf.json simulation if not given")
+    parser.add_argument("--fail-fast", nargs="*", choices=FAIL_FAST, help="Fail-fast criteria, conf.json's if not given")
+    parser.add_argument("--skip-phase", type=int, nargs="+", choices=(1, 2, 3), default=(), help="Phases left out of the tests")
+    parser.add_argument("--crash", type=float, help="Crash every test this many seconds in and recover it from its journal")
+    args = parser.parse_args()
+
+    adapters = TestableAdapters()
+    adapters.load_values()
+    names = [a.name for a in adapters.adapters]
+    selected = args.adapter or names[:1]
+    for name in selected:
+        if name not in names:
+            print(colorama.Fore.RED, f"Adapter {name} not found in adapters.json", colorama.Fore.RESET)
+            sys.exit(1)
+
+    tester = SimulatedTester(None)
+    # The simulated adapter gets its rating from the tested one when it's plugged in, the rest of it from conf.json
+    simulation = {k: v for k, v in tester.settings.simulation.items() if k != "speed"}
+    if args.opp is not None:
+        simulation["opp_load"] = args.opp
+    tester.settings.batch_file = None
+    if args.fail_fast is not None:
+        tester.settings.fail_fast = args.fail_fast
+    for phase in args.skip_phase:
+        [tester.settings.phase1, tester.settings.phase2, tester.settings.phase3][phase - 1][0] = False
+    tester.backend = SimulatedBackend(tester.settings, speed=args.speed, **simulation)
+    # Every bucket still gets raw samples, more than the machine can read would stretch the virtual time
+    tester.settings.max_raw_sample_rate = min(tester.settings.max_raw_sample_rate, max(1 / tester.bucket_period, SIM_READS_PER_SECOND / args.speed))
+    tester.setup()
+
+    runs = []
+    for name in selected:
+        plug_in(tester, tester.testable_adapters.adapters[names.index(name)])
+        runs.append(check_constant_load(tester))
+        for profile in args.profiles or [tester.default_profile]:
+            for _ in range(args.runs):
+                run = run_test(tester, profile) if args.crash is None else crash_test(tester, profile, args.crash)
+                if run is None:
+                    print(colorama.Fore.RED, f"{name}, {profile}: test didn't start", colorama.Fore.RESET)
+                    runs.append({"passed": False})
+                    continue
+                runs.append(dict(run, adapter=name))
+    tester.shutdown()
+
+    print()
+    for run in runs:
+        if "profile" in run:
+            report(run)
+    sys.exit(0 if runs and all(run["passed"] for run in runs) else 1)
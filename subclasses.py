@@ -14,6 +14,16 @@ import json
 import os
 import traceback
 import csv
+import threading
+import itertools
+from collections import deque, namedtuple
+from time import perf_counter_ns
+from acquisition import Bucket
+from ina219_reader import ADC_MODES
+from sample_ring import SampleRing, LoadSegments, Segment
+from test_engine import CancelToken
+from profiles import DWELL, SCHEDULE
+from calibration import CALIBRATION_FILE, CalibrationTable
 
 
 empty_fig = go.Figure()
@@ -21,86 +31,283 @@ empty_fig.update_layout(plot_bgcolor="#3a3a3a", paper_bgcolor="#2a2a2a", font=di
 empty_fig.update_xaxes(gridcolor="#444444")
 empty_fig.update_yaxes(gridcolor="#444444")
 
+# One log entry, seq counts every message ever logged, t is monotonic ns, wall the local time for display.
+# color is the level, text a string (may span lines) or the result list for "TEST RESULTS"
+Message = namedtuple("Message", ["seq", "t", "wall", "color", "text"])
+
+
+class MessageLog:
+    # Bounded log, every reader keeps the seq of the last message it has shown and asks only for newer ones
+    def __init__(self, max_len: int = 250):
+        self.entries = deque(maxlen=max_len)
+        self.seq: int = 0  # Seq of the newest message
+        self._lock = threading.Lock()
+
+    @property
+    def max_len(self) -> int:
+        return self.entries.maxlen
+
+    @max_len.setter
+    def max_len(self, value: int):
+        with self._lock:
+            self.entries = deque(self.entries, maxlen=value)
+
+    def add(self, text, color) -> Message:
+        with self._lock:
+            self.seq += 1
+            msg = Message(self.seq, perf_counter_ns(), datetime.now(), color, text)
+            self.entries.append(msg)
+        return msg
+
+    def since(self, seq: int) -> [Message]:
+        # Messages newer than seq, oldest first, only the ones still in the log if the reader fell far behind
+        with self._lock:
+            if seq >= self.seq:
+                return []
+            new = min(self.seq - seq, len(self.entries))
+            return list(itertools.islice(self.entries, len(self.entries) - new, None))
+
+
+# Consistent copy of the sample columns, all of the same length, start is the index of the first sample
+Snapshot = namedtuple("Snapshot", ["start", "timestamps", "voltage", "current", "load", "v_min", "v_max", "c_min", "c_max", "counts"])
+
+
 class DataStorage:
-    def __init__(self):
-        self.voltage: [float] = []
-        self.current: [float] = []
-        self.load: [int] = []
-        self.messages: [dict] = []
-        self.max_len: int = 250  # Change to display more / fewer messages in GUI
+    # Samples live in a SampleRing written by the sampler (a thread here, or another process through shared memory),
+    # readers use snapshot() / latest() which never lock: the ring only publishes a sample once all its columns are written,
+    # and clearing only moves self.base, the ring index of sample 0, so the writer never has to be stopped.
+    # While idle the ring is a fixed window, during a test a local ring doubles whenever the test would overwrite its own start
+    def __init__(self, capacity: int = 4096):
+        # One value per 100ms bucket, voltage and current are the bucket means
+        self.samples = SampleRing(capacity)
+        self.idle_capacity = capacity
+        self.per_second = SampleRing(4096)  # 1s buckets for the graph, never cleared by tests
+        self.base: int = 0
+        self.max_idle: int = 1800  # Samples kept while not testing
+        self.temperature: [float] = []  # °C, from the background temperature sampler
+        self.temp_timestamps: [int] = []
+        self.max_temps: int = 1800
+        self.max_seconds: int = 1800
+        self.messages = MessageLog(250)
         self.url = "/"
         self.old_url = "/"
         self.testing = False
-
-    def new_values(self, v: float, c: float, l: float, connected: bool):
-        if not self.testing and len(self.voltage) > 1800:
-            self.voltage = self.voltage[-10:]
-            self.current = self.current[-10:]
-            self.load = self.load[-10:]
-            msg = "Cleaning values"
-            print(colorama.Fore.BLUE, msg, colorama.Fore.RESET)
-            self.add_message(msg, BLUE)
-        if not connected:
-            v = 0
-            c = 0
-            l = 0
-        self.voltage.append(v)
-        self.current.append(c)
-        self.load.append(l)
+        self._trim_lock = threading.Lock()
+        self._overwrite_warned = False
+        self.load_segments = LoadSegments()  # Load runs since base, brought up to date when queried
+        self._load_lock = threading.Lock()
+        self._new_sample = threading.Condition()  # Notified by the writer if it's in this process
+
+    def use_rings(self, samples: SampleRing, per_second: SampleRing):
+        # Read the rings of a sampler process instead of the local ones, shared rings can't grow so they are sized for a whole test
+        self.samples = samples
+        self.idle_capacity = samples.capacity
+        self.per_second = per_second
+        self.base = samples.count
+
+    def _window(self) -> (SampleRing, int, int, int):
+        # (ring, base, first, end), samples [first, end) of the ring are the current ones, first is past base if the ring already reused them
+        ring = self.samples
+        end = ring.count
+        if not self.testing and end - self.base > self.max_idle:
+            with self._trim_lock:
+                if end - self.base > self.max_idle:
+                    self.base = end - 10
+                    msg = "Cleaning values"
+                    print(colorama.Fore.BLUE, msg, colorama.Fore.RESET)
+                    self.add_message(msg, BLUE)
+        base = self.base
+        if self.testing and end - base > ring.capacity and not self._overwrite_warned:
+            self._overwrite_warned = True
+            msg = f"Test is longer than {ring.capacity} samples, the oldest ones are being overwritten"
+            print(colorama.Fore.YELLOW, msg, colorama.Fore.RESET)
+            self.add_message(msg, ORANGE)
+        return ring, base, max(base, end - ring.capacity), end
+
+    def new_values(self, b: Bucket, l: float, connected: bool):
+        # Only the writer resizes, a reader still holding the old ring keeps a consistent copy
+        used = self.samples.count - self.base
+        if self.testing and used >= self.samples.capacity:
+            self.samples = self.samples.resized(self.samples.capacity * 2)
+        elif not self.testing and self.samples.capacity > self.idle_capacity and used <= self.max_idle:
+            self.samples = self.samples.resized(self.idle_capacity)
+        self.samples.append(b, l, connected)
+        with self._new_sample:
+            self._new_sample.notify_all()
+
+    def snapshot(self, start: int = 0, stop: int = None) -> Snapshot:
+        # Columns are views into the ring, they stay valid until the ring comes around to them again
+        ring, base, first, end = self._window()
+        start = max(first, base + start)
+        if stop is not None:
+            end = min(end, base + stop)
+        return Snapshot(start - base, *ring.read(start, end))
+
+    def latest(self) -> (int, float, float, float):
+        # (index, mean voltage, min voltage, mean current) of the newest sample, index -1 if there is none
+        ring, base, first, end = self._window()
+        if end <= first:
+            return -1, 0.0, 0.0, 0.0
+        i = end - 1
+        return i - base, float(ring.at(i, ring.voltage)), float(ring.at(i, ring.v_min)), float(ring.at(i, ring.current))
+
+    def last_index(self) -> int:
+        ring, base, first, end = self._window()
+        return end - base - 1
+
+    def _load_index(self) -> LoadSegments:
+        ring, base, first, end = self._window()
+        with self._load_lock:
+            if self.load_segments.start != base:
+                # Cleared or trimmed since the last query
+                self.load_segments = LoadSegments(base)
+            self.load_segments.update(ring)
+            return self.load_segments
+
+    def count_load(self, level: int, start: int = 0) -> int:
+        # Samples from start on that were taken at this load
+        segments = self._load_index()
+        return segments.count(level, segments.start + start)
+
+    def next_load_index(self, start: int, loaded: bool = True) -> int:
+        # First index from start on with a load (or without one if loaded is False), None if there is none yet
+        segments = self._load_index()
+        i = segments.find(segments.start + start, loaded)
+        return None if i is None else i - segments.start
+
+    def load_steps(self, start: int = 0, stop: int = None) -> [Segment]:
+        # Load steps between two indices, with start / stop as sample indices
+        segments = self._load_index()
+        stop = segments.seen if stop is None else segments.start + stop
+        return [s._replace(start=s.start - segments.start, stop=s.stop - segments.start)
+                for s in segments.between(segments.start + start, stop)]
+
+    def wait_for_load(self, level: int, n: int, start: int = 0, token: CancelToken = None) -> bool:
+        # Blocks until n samples from start on were taken at this load, False if the token got cancelled first
+        if token is not None:
+            token.wake_on_cancel(self._new_sample)
+        while token is None or not token.cancelled:
+            if self.count_load(level, start) >= n:
+                return True
+            with self._new_sample:
+                # Timeout for a sampler in another process, it can't notify
+                self._new_sample.wait(.05)
+        return False
+
+    def wait_for_settled(self, level: int, start: int, n_min: int, n_max: int, settled, token: CancelToken = None) -> int:
+        # Blocks until n_max samples from start on were taken at this load, or n_min and settled(voltage, v_min, v_max) of them is True.
+        # Number of samples at the load, None if cancelled
+        def check(snap):
+            at = snap.load == level
+            n = int(np.count_nonzero(at))
+            if n >= n_max or (n >= n_min and settled(snap.voltage[at], snap.v_min[at], snap.v_max[at])):
+                return n
+            return None
+        return self._watch(start, token, check)
+
+    def _watch(self, start: int, token: CancelToken, check):
+        # Calls check(snapshot from start on) whenever new samples arrived, until it returns something other than None. None if cancelled
+        if token is not None:
+            token.wake_on_cancel(self._new_sample)
+        while token is None or not token.cancelled:
+            res = check(self.snapshot(start))
+            if res is not None:
+                return res
+            with self._new_sample:
+                self._new_sample.wait(.05)
+        return None
+
+    def wait_for_dip(self, threshold: float, start: int, n: int, token: CancelToken = None) -> int:
+        # Blocks until a sample from start on dips below threshold (its index) or n samples stayed above it (-1), None if cancelled
+        def check(snap):
+            dips = np.flatnonzero(snap.v_min[:n] < threshold)
+            if len(dips):
+                return snap.start + int(dips[0])
+            return -1 if len(snap.v_min) >= n else None
+        return self._watch(start, token, check)
+
+    def wait_for_recovery(self, threshold: float, start: int, n: int, limit: int, token: CancelToken = None) -> int:
+        # Blocks until n samples in a row from start on stayed at or above threshold, index of the first of them.
+        # -1 if that didn't happen within limit samples, None if cancelled
+        def check(snap):
+            ok = snap.v_min[:limit] >= threshold
+            if len(ok) >= n:
+                runs = np.flatnonzero(np.convolve(ok, np.ones(n, dtype=int), "valid") == n)
+                if len(runs):
+                    return snap.start + int(runs[0])
+            return -1 if len(ok) >= limit else None
+        return self._watch(start, token, check)
+
+    def new_second(self, b: Bucket, l: float, connected: bool):
+        self.per_second.append(b, l, connected)
+
+    def seconds_snapshot(self) -> Snapshot:
+        end = self.per_second.count
+        return Snapshot(0, *self.per_second.read(end - self.max_seconds, end))
+
+    def new_temp(self, temp: float, t: int):
+        if len(self.temperature) >= self.max_temps and not self.testing:
+            self.temperature = self.temperature[-self.max_temps // 2:]
+            self.temp_timestamps = self.temp_timestamps[-self.max_temps // 2:]
+        self.temperature.append(temp)
+        self.temp_timestamps.append(t)
 
     def clear(self):
-        self.voltage = []
-        self.current = []
-        self.load = []
+        self.temperature = []
+        self.temp_timestamps = []
+        self._overwrite_warned = False
+        self.base = self.samples.count
+
+    def seconds(self, timestamps) -> np.ndarray:
+        # Sample timestamps converted to seconds since the first sample
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        if len(timestamps) == 0:
+            return np.zeros(0)
+        return (timestamps - timestamps[0]) / 1e9
+
+    @property
+    def max_len(self) -> int:
+        # Change to display more / fewer messages in GUI
+        return self.messages.max_len
+
+    @max_len.setter
+    def max_len(self, value: int):
+        self.messages.max_len = value
 
     def add_message(self, text, color):
-        timestamp = f"[{datetime.now().strftime('%H:%M:%S')}]"
-
-        if color == "TEST RESULTS":
-            self.messages.append({
-                    "text": [timestamp] + text,
-                    "color": "TEST RESULTS"
-                })
-
-        elif "\n" in text:
-            # Multi line message
-            for line in text.split("\n"):
-                self.messages.append({
-                    "text": f"{timestamp};{line}",
-                    "color": color
-                })
-                if len(self.messages) > self.max_len:
-                    self.messages.pop(0)
-        else:
-            # Single-line message
-            self.messages.append({
-                "text": f"{timestamp};{text.strip()}",
-                "color": color
-            })
-            if len(self.messages) > self.max_len:
-                self.messages.pop(0)
+        if color != "TEST RESULTS" and "\n" not in text:
+            text = text.strip()
+        self.messages.add(text, color)
 
 
 class AppSettings:
     def __init__(self):
         self.max_current_shutdown = 3.2
         self.per_sec = False
-        self.high_res = False
+        self.adc_mode = "9BIT_1S"  # One of ina219_reader.ADC_MODES
         self.exit_at_safety = True
         self.phase1 = [True, 1]
         self.phase2 = [True, 1]
         self.phase3 = [True, 1, 3]
-        self.pwm_mappings = []  # {Current(A): Load(%)}
+        self.pwm_mappings = []  # [(PWM duty, Current(A))] measured points of the load calibration
+        self.calibration = CalibrationTable([])  # pwm_mappings compiled for the amps -> duty lookup
+        self.i2c_frequency = 400000  # Hz, on the Pi the kernel setting (dtparam=i2c_arm_baudrate) has to match
+        self.max_raw_sample_rate = 500  # Hz, cap for raw sensor reads, they get aggregated into 100ms and 1s buckets
+        self.hardware_backend = "pi"  # "pi" or "sim"
+        self.simulation = {}  # Arguments for hardware.SimulatedBackend, e.g. speed and the simulated adapter
+        self.sampler_process = False  # Sample in a separate process, keeps the sampling timing away from the UI load
+        self.batch_file = None  # Batch queue JSON, tests start by themselves when a unit gets plugged in (batch_queue.load_batch)
+        self.fail_fast = []  # Criteria that end a test at their first definitive failure, any of tester.FAIL_FAST
         self.load_values()
 
-    def new_values(self, mcs, max_exit: bool, ps: bool, hr: bool, p1incl: bool, p1rep, p2incl: bool, p2rep, p3incl: bool, p3rep, p3opp) -> dict:
+    def new_values(self, mcs, max_exit: bool, ps: bool, adc_mode: str, p1incl: bool, p1rep, p2incl: bool, p2rep, p3incl: bool, p3rep, p3sc) -> dict:
         msg = ""
         try:
             mcs = float(mcs)
             p1rep = int(p1rep)
             p2rep = int(p2rep)
             p3rep = int(p3rep)
-            p3opp = int(p3opp)
+            p3sc = int(p3sc)
 
             if not 0 < mcs <= 3.2:
                 msg = "Max current shutdown must be between 0 and 3.2A"
@@ -118,8 +325,12 @@ class AppSettings:
                 msg = "Phase 3 repeats must be between 1 and 5 incl."
                 raise ValueError
 
-            elif not 3 <= p3opp <= 10:
-                msg = "Looking for OPP trip point must be between 3 and 10 incl."
+            elif not 3 <= p3sc <= 10:
+                msg = "Short circuit tries must be between 3 and 10 incl."
+                raise ValueError
+
+            elif adc_mode not in ADC_MODES:
+                msg = "Unknown ADC mode."
                 raise ValueError
 
         except ValueError:
@@ -132,11 +343,11 @@ class AppSettings:
 
         self.max_current_shutdown = mcs
         self.per_sec = ps
-        self.high_res = hr
+        self.adc_mode = adc_mode
         self.exit_at_safety = max_exit
         self.phase1 = [p1incl, p1rep]
         self.phase2 = [p2incl, p2rep]
-        self.phase3 = [p3incl, p3rep, p3opp]
+        self.phase3 = [p3incl, p3rep, p3sc]
 
         self.save_values()
         return {
@@ -148,9 +359,17 @@ class AppSettings:
         with open('conf.json', 'r') as f:
             data = json.load(f)
             self.per_sec = data.get('graph_data_per_sec', self.per_sec)
-            self.high_res = data.get('high_res_mode', self.high_res)
+            # Older configs only had a high / low resolution switch
+            self.adc_mode = data.get('adc_mode', "12BIT_1S" if data.get('high_res_mode') else self.adc_mode)
             self.max_current_shutdown = data.get('max_current_shutdown', self.max_current_shutdown)
             self.exit_at_safety = data.get('exit_at_safety', self.exit_at_safety)
+            self.i2c_frequency = data.get('i2c_frequency', self.i2c_frequency)
+            self.max_raw_sample_rate = data.get('max_raw_sample_rate', self.max_raw_sample_rate)
+            self.hardware_backend = data.get('hardware_backend', self.hardware_backend)
+            self.simulation = data.get('simulation', self.simulation)
+            self.sampler_process = data.get('sampler_process', self.sampler_process)
+            self.batch_file = data.get('batch_file', self.batch_file)
+            self.fail_fast = data.get('fail_fast', self.fail_fast)
             phases = []
             phases = data.get('phases', phases)
             for phase in phases:
@@ -159,23 +378,26 @@ class AppSettings:
                 elif phase["phase"] == 2:
                     self.phase2 = [phase["include"], phase["repeat"]]
                 elif phase["phase"] == 3:
-                    self.phase3 = [phase["include"], phase["repeat"], phase["look_for_trip_point"]]
+                    # Files from before the OPP search bisected have the short circuit tries as look_for_trip_point
+                    self.phase3 = [phase["include"], phase["repeat"], phase["short_circuit_tries"] if "short_circuit_tries" in phase else phase["look_for_trip_point"]]
                 else:
                     print(colorama.Fore.YELLOW, "Invalid settings, continuing with default settings", colorama.Fore.RESET)
                     self.set_defaults()
                     break
         # Load calibration data
-        with open('pwm_mapping_data.csv', newline='') as f:
+        self.pwm_mappings = []
+        with open(CALIBRATION_FILE, newline='') as f:
             reader = csv.DictReader(f)
             for row in reader:
                 pwm = float(row['pwm'])
                 current = float(row['current'])
                 self.pwm_mappings.append((pwm, current))
+        self.calibration = CalibrationTable(self.pwm_mappings)
 
     def set_defaults(self):
         self.max_current_shutdown = 3.2
         self.per_sec = False
-        self.high_res = False
+        self.adc_mode = "9BIT_1S"
         self.exit_at_safety = True
         self.phase1 = [True, 1]
         self.phase2 = [True, 1]
@@ -185,8 +407,15 @@ class AppSettings:
         config_data = {
             "max_current_shutdown": self.max_current_shutdown,
             "graph_data_per_sec": self.per_sec,
-            "high_res_mode": self.high_res,
+            "adc_mode": self.adc_mode,
             "exit_at_safety": self.exit_at_safety,
+            "i2c_frequency": self.i2c_frequency,
+            "max_raw_sample_rate": self.max_raw_sample_rate,
+            "hardware_backend": self.hardware_backend,
+            "simulation": self.simulation,
+            "sampler_process": self.sampler_process,
+            "batch_file": self.batch_file,
+            "fail_fast": self.fail_fast,
             "phases": [
                 {
                     "phase": 1,
@@ -202,7 +431,7 @@ class AppSettings:
                     "phase": 3,
                     "include": self.phase3[0],
                     "repeat": self.phase3[1],
-                    "look_for_trip_point": self.phase3[2]
+                    "short_circuit_tries": self.phase3[2]
                 }
             ]
         }
@@ -224,7 +453,7 @@ class TestableAdapters:
         self.data = data["adapters"]
         for a in self.data:
             self.adapters.append(Adapter(a["name"], a["max_current"], a["max_voltage"], a["min_voltage"],
-                                         a["voltage_tolerance"], a["min_OPP"], a["max_OPP"]))
+                                         a["voltage_tolerance"], a["min_OPP"], a["max_OPP"], a.get("profile")))
             # Loading adapter from adapters.json
 
     def add_new_adapter(self, name, max_current, max_voltage, min_voltage, v_tol, opp_min, opp_max):
@@ -282,7 +511,9 @@ class TestableAdapters:
 
 
 class Adapter:
-    def __init__(self, n: str, mc: float, mv: float, nv: float, vt: float, on: int, om: int):
+    __slots__ = ("name", "max_current", "max_voltage", "min_voltage", "v_tol", "OPP_min", "OPP_max", "profile")
+
+    def __init__(self, n: str, mc: float, mv: float, nv: float, vt: float, on: int, om: int, profile: str = None):
         self.name = n
         self.max_current = mc
         self.max_voltage = mv
@@ -290,6 +521,13 @@ class Adapter:
         self.v_tol = vt  # Voltage tolerance
         self.OPP_min = on
         self.OPP_max = om
+        self.profile = profile  # Test profile from profiles.json, the default one if None
+
+
+# One out of bounds sample, voltage is the raw min or max that broke the bounds
+OOB_RECORD = np.dtype([("voltage", "f4"), ("current", "f4"), ("load", "f4"), ("expected_min", "f4"), ("expected_max", "f4")])
+# Sample checks of one phase over samples [start, stop), oob is the voltage out of bounds mask of those samples
+PhaseResult = namedtuple("PhaseResult", ["phase", "start", "stop", "passed", "oob", "current_oob", "OOB_results"])
 
 
 class EvaluateResults:
@@ -303,17 +541,33 @@ class EvaluateResults:
         self.test_valid: bool = True
         self.scp_pass: bool = True
         self.print_results: bool = False
-        self.OOB_results = []
-        self.bottom_border = []
-        self.top_border = []
-        self.voltage = []  # Trimmed Correctly
-        self.voltage_good = [] # for graph
-        self.voltage_oob = [] # Voltage out of bounds
-        self.current = []  # Trimmed Correctly
-        self.load = []  # Trimmed Correctly
+        self.OOB_results = np.zeros(0, dtype=OOB_RECORD)
+        self.bottom_border = np.zeros(0, dtype=np.float32)  # NaN outside phase 1 and 2
+        self.top_border = np.zeros(0, dtype=np.float32)
+        self.voltage = np.zeros(0, dtype=np.float32)  # Trimmed Correctly
+        self.voltage_good = np.zeros(0, dtype=np.float32)  # for graph, NaN where out of bounds
+        self.voltage_oob = np.zeros(0, dtype=np.float32)  # Voltage out of bounds, NaN where in bounds
+        self.current = np.zeros(0, dtype=np.float32)  # Trimmed Correctly
+        self.load = np.zeros(0, dtype=np.uint16)  # Trimmed Correctly
+        self.time = np.zeros(0)  # Seconds since the first sample, trimmed correctly
+        self.v_min = np.zeros(0, dtype=np.float32)  # Lowest raw voltage in each sample, trimmed correctly
+        self.v_max = np.zeros(0, dtype=np.float32)  # Highest raw voltage in each sample, trimmed correctly
+        self.temperature = []  # Temperatures measured during the test
+        self.temp_time = []  # Seconds since the first sample
+        self.steps = []  # (load, start index, stop index, start in seconds since the first sample) of every load step
         self.OPP_trips = []
-        self.phase = []
+        self.opp_brackets = []  # [highest load held, lowest load tripped, overload events] of every OPP search
+        self.phase = np.zeros(0, dtype=np.int8)
         self.fin_message = None
+        self.recovered_from = None  # Journal file, if this test was recovered after a crash
+        self.fail_fast = None  # Why the test was ended early, if a fail-fast criterion did
+        self.skipped = []  # Included phases that didn't run because of it
+        self.time_saved = 0.0  # Estimated seconds of the test it didn't have to run
+        self.state_times = {}  # Seconds on the test clock spent in every state of the test engine before the results, wall time on the Pi
+        self.profile = None  # Name of the test profile
+        self.serial = None  # Serial number of the tested unit, batch tests only
+        self.schedule = np.zeros(0, dtype=SCHEDULE)  # The profile compiled for this test, with the sample indices every step ran between
+        self.file_name = None  # Set once the test file is written
         self.test_number = 1
         self.load_id_tracker()
 
@@ -338,11 +592,39 @@ class EvaluateResults:
             with open(file_name, 'wb') as f:
                 pickle.dump({'date': current_date, 'test_number': self.test_number}, f)
 
-    def eval(self, voltage: list, current: list, load: list, test_values: dict, tested_adapter: Adapter):
+    def voltage_bounds(self, tested_adapter: Adapter) -> (float, float):
+        return tested_adapter.max_voltage * (100 - tested_adapter.v_tol) / 100, tested_adapter.max_voltage * (100 + tested_adapter.v_tol) / 100
+
+    def eval_phase(self, phase: int, start: int, stop: int, voltage: np.ndarray, current: np.ndarray, load: np.ndarray, v_min: np.ndarray,
+                   v_max: np.ndarray, tested_adapter: Adapter) -> PhaseResult:
+        # Sample by sample checks of phase 1 or 2, final as soon as the phase ended, so the tester runs them while the next phase runs.
+        # Doesn't touch self, the columns may be the whole test or only as much of it as was journaled
+        v_bottom_bound, v_top_bound = self.voltage_bounds(tested_adapter)
+        v, a, vn, vx = voltage[start:stop], current[start:stop], v_min[start:stop], v_max[start:stop]
+        # From load to amps -> (load / 100) * max
+        l = np.asarray(load[start:stop], dtype=np.float32)
+        a_bottom = ((l - self.a_tol) / 100) * tested_adapter.max_current
+        a_top = ((l + self.a_tol) / 100) * tested_adapter.max_current
+        current_oob = int(np.count_nonzero((a < a_bottom) | (a > a_top)))
+        oob = (vn < v_bottom_bound) | (vx > v_top_bound)
+
+        where = np.flatnonzero(oob)
+        records = np.zeros(len(where), dtype=OOB_RECORD)
+        records["voltage"] = np.where(vn[where] < v_bottom_bound, vn[where], vx[where])
+        records["current"] = a[where]
+        records["load"] = l[where]
+        records["expected_min"] = v_bottom_bound
+        records["expected_max"] = v_top_bound
+        return PhaseResult(phase, start, stop, not oob.any(), oob, current_oob, records)
+
+    def eval(self, voltage: np.ndarray, current: np.ndarray, load: np.ndarray, timestamps: np.ndarray, v_min: np.ndarray, v_max: np.ndarray,
+             test_values: dict, tested_adapter: Adapter, steps: [Segment] = (), phase_results: {int: PhaseResult} = None):
         # phase 1 = +- tolerance%
         # phase 2 = +- tolerance%
         # OPP within spec
         # AMC/AMV/AML = adapter max current / voltage
+        # The channels are read-only views (journal / ring), trimming slices them so they are kept, written and plotted without copies.
+        # Phase results the tester evaluated while the test ran are merged in, if they still cover the phase
         self.v_tol = tested_adapter.v_tol
         load = load[:test_values[2]["stop_index"]]
         self.load = load
@@ -350,70 +632,54 @@ class EvaluateResults:
         self.voltage = voltage
         current = current[:test_values[2]["stop_index"]]
         self.current = current
+        self.time = self.data_storage.seconds(timestamps[:test_values[2]["stop_index"]])
+        if len(timestamps):
+            t0, t_stop = timestamps[0], timestamps[:test_values[2]["stop_index"]][-1]
+            for temp, t in zip(self.data_storage.temperature, self.data_storage.temp_timestamps):
+                if t0 <= t <= t_stop:
+                    self.temperature.append(temp)
+                    self.temp_time.append((t - t0) / 1e9)
+            self.steps = [(s.level, s.start, s.stop, (s.t - t0) / 1e9) for s in steps]
+        # Bucket min / max, so a glitch shorter than a bucket still fails the test
+        v_min = v_min[:test_values[2]["stop_index"]]
+        self.v_min = v_min
+        v_max = v_max[:test_values[2]["stop_index"]]
+        self.v_max = v_max
         self.scp_pass = test_values[2]["short_circuit"]
-        v_bottom_bound = tested_adapter.max_voltage * (100 - self.v_tol) / 100
-        v_top_bound = tested_adapter.max_voltage * (100 + self.v_tol) / 100
-        was_last_ok = True
+        v_bottom_bound, v_top_bound = self.voltage_bounds(tested_adapter)
+
+        # Plot bounds and Evaluate completion of the phases, one array operation per check instead of a loop over the samples.
+        # Values that aren't plotted are NaN, plotly leaves a gap there like it did for None
+        n = len(load)
+        index = np.arange(n)
+        p1_stop, p2_stop = test_values[0]["stop_index"], test_values[1]["stop_index"]
+        checked = index < p2_stop  # Phase 1 and 2 are checked sample by sample
+        self.bottom_border = np.where(checked, v_bottom_bound, np.nan).astype(np.float32)
+        self.top_border = np.where(checked, v_top_bound, np.nan).astype(np.float32)
+        self.phase = np.where(index < p1_stop, 1, np.where(checked, 2, 3)).astype(np.int8)
+
+        oob = np.zeros(n, dtype=bool)
         current_obb_counter = 0
-
-        # Plot bounds and Evaluate completion of the phases
-        for i, l in enumerate(load):
-            # From load to amps -> (load / 100) * max
-            # Plotting +- v_tolerance window = amv * 100 + v_tol / 100
-            # Load is a consistent and shows the expected results for amps
-            v = voltage[i]
-            a = current[i]
-            if i < test_values[1]['stop_index']:
-                # Save vals so that we can highlight the range on graph
-                self.bottom_border.append(v_bottom_bound)
-                self.top_border.append(v_top_bound)
-                if a < ((l - self.a_tol) / 100) * tested_adapter.max_current or a > ((l + self.a_tol) / 100) * tested_adapter.max_current:
-                    # Current is out of bounds
-                    current_obb_counter += 1
-
-                if v < v_bottom_bound or v > v_top_bound:
-                    # Voltage is out of bounds
-                    if was_last_ok:
-                        # Handles transitions from yellow to red line, so that it looks nice. Last value needs to be added to both so that it looks as if its connected
-                        try:
-                            self.voltage_oob.pop()
-                        except IndexError:
-                            pass
-                        self.voltage_oob.append(voltage[i - 1])
-                        
-                    self.add_OOB_result(v, a, l, v_bottom_bound, v_top_bound)
-                    self.voltage_good.append(None)
-                    self.voltage_oob.append(v)
-                    was_last_ok = False
-
-                    if i < test_values[0]["stop_index"]:  # If i in phase1
-                        self.phase1_pass = False
-                    elif i < test_values[1]["stop_index"]:  # If i in phase2
-                        self.phase2_pass = False
-                    else:
-                        raise ValueError("This is not possible")
-
-                else:
-                    # Voltage is not out of bounds
-                    if not was_last_ok:
-                        # Handles transitions from yellow to red line, so that it looks nice. Last value needs to be added to both so that it looks as if its connected
-                        self.voltage_oob.append(v)
-                    else:
-                        self.voltage_oob.append(None)
-                    self.voltage_good.append(v)
-                    was_last_ok = True
+        records = []
+        for phase, start, stop in ((1, 0, p1_stop), (2, p1_stop, p2_stop)):
+            res = (phase_results or {}).get(phase)
+            if res is None or (res.start, res.stop, len(res.oob)) != (start, stop, len(oob[start:stop])):
+                res = self.eval_phase(phase, start, stop, voltage, current, load, v_min, v_max, tested_adapter)
+            oob[start:stop] = res.oob
+            current_obb_counter += res.current_oob
+            records.append(res.OOB_results)
+            if phase == 1:
+                self.phase1_pass = res.passed
             else:
-                self.voltage_good.append(v)
-                self.voltage_oob.append(None)
-                self.bottom_border.append(None)
-                self.top_border.append(None)
-
-            if i < test_values[0]["stop_index"]:
-                self.phase.append(1)
-            elif i < test_values[1]["stop_index"]:
-                self.phase.append(2)
-            else:
-                self.phase.append(3)
+                self.phase2_pass = res.passed
+        self.OOB_results = np.concatenate(records)
+
+        # Out of bounds samples go on the red line together with their neighbours, so it connects to the yellow one
+        on_oob_line = oob.copy()
+        on_oob_line[:-1] |= oob[1:]
+        on_oob_line[1:] |= oob[:-1] & checked[1:]
+        self.voltage_good = np.where(oob, np.nan, voltage).astype(np.float32)
+        self.voltage_oob = np.where(on_oob_line, voltage, np.nan).astype(np.float32)
 
         # Saving OPP results
         # self.OPP_trips = [[voltages: float], [currents: float], [loads: float], [fine: bool]]
@@ -436,6 +702,7 @@ class EvaluateResults:
             self.test_valid = False
 
         self.OPP_trips = [v, a, l, b]
+        self.opp_brackets = test_values[2].get("OPP_brackets", [])
         self.fin_message = [self.phase1_pass, self.phase2_pass, self.phase3_pass, self.scp_pass, self.test_valid, test_values[2]["OPP_trip_load"]]
 
         # Optional print
@@ -447,13 +714,15 @@ class EvaluateResults:
             for s_index in range(100, 10, -10):
                 print(f"sindex = {-s_index} -> {-(s_index - 10)}    |    vals: {l_phase1[-s_index: -(s_index - 10)]}")
             print(l_phase1[-10:])
-            print(f"LEN: {len(l_phase2)}    |    100s: {l_phase2.count(100)}    |    "
-                  f"0s: {l_phase2.count(0)}    |    First 10: {l_phase2[-130:-110]}")
+            print(f"LEN: {len(l_phase2)}    |    100s: {np.count_nonzero(l_phase2 == 100)}    |    "
+                  f"0s: {np.count_nonzero(l_phase2 == 0)}    |    First 10: {l_phase2[-130:-110]}")
             for i, x in enumerate(test_values[2]['OPP_trip_index']):
                 print(f"load: {load[x]} -> recalcd: {(test_values[2]['OPP_trip_load'])[i]}")
 
     def write_data_into_file(self, tested_adapter, tested_settings):
         # Open the HDF5 file and write data
+        # Read again, an earlier test may have been written since this one was created
+        self.load_id_tracker()
         self.test_number += 1
         test_id = f"{tested_adapter.name.upper()}-{datetime.now().strftime('%Y%m%d')}-{self.test_number:03d}-{''.join(random.choices(string.ascii_uppercase + string.digits, k=4))}"
         with open('id_tracker.pkl', 'wb') as f:
@@ -480,10 +749,23 @@ class EvaluateResults:
             details_group.attrs['Phase2_Passed'] = self.phase2_pass
             details_group.attrs['Phase3_Included'] = tested_settings.phase3[0]
             details_group.attrs['Phase3_No_Reps'] = tested_settings.phase3[1]
-            details_group.attrs['Phase3_Look_For_OPP_Trip_times'] = tested_settings.phase3[2]
+            details_group.attrs['Phase3_Short_Circuit_Tries'] = tested_settings.phase3[2]
             details_group.attrs['Phase3_Passed'] = self.phase3_pass
             details_group.attrs['Phase3_Short_Circuit_Passed'] = self.scp_pass
+            for phase in (1, 2, 3):
+                details_group.attrs[f'Phase{phase}_Skipped'] = phase in self.skipped
+            details_group.attrs['Fail_Fast'] = self.fail_fast or ""
+            details_group.attrs['Station_Time_Saved(sec)'] = self.time_saved
             details_group.attrs['Is_Test_Valid'] = self.test_valid
+            details_group.attrs['Recovered_From_Journal'] = self.recovered_from or ""
+            details_group.attrs['Test_Profile'] = self.profile or ""
+            details_group.attrs['Serial'] = self.serial or ""
+            dwells = self.schedule[(self.schedule["kind"] == DWELL) & (self.schedule["used"] >= 0)]
+            details_group.attrs['Dwell_Samples_Planned'] = int(dwells["samples"].sum())
+            details_group.attrs['Dwell_Samples_Used'] = int(dwells["used"].sum())
+            for state, seconds in self.state_times.items():
+                details_group.attrs[f'{state}_Time(sec)'] = seconds  # Test clock, a simulated test has its virtual time here
+            details_group.attrs['Max_Temperature(C)'] = max(self.temperature) if self.temperature else np.nan
 
             # Measured data
             num_rows = len(self.voltage)
@@ -491,19 +773,23 @@ class EvaluateResults:
                 ('Voltage Bottom Bound (V)', 'f4'),
                 ('Voltage (V)', 'f4'),
                 ('Voltage Top Bound (V)', 'f4'),
+                ('Voltage Min (V)', 'f4'),
+                ('Voltage Max (V)', 'f4'),
                 ('Current (A)', 'f4'),
                 ('Load (%)', 'i4'),
-                ('Time (sec)', 'i4'),
+                ('Time (sec)', 'f4'),
                 ('Phase', 'i4')
             ])
-            # Populate the array
-            data['Voltage Bottom Bound (V)'] = np.array(self.bottom_border, dtype=float)
-            data['Voltage (V)'] = np.array(self.voltage, dtype=float)
-            data['Voltage Top Bound (V)'] = np.array(self.top_border, dtype=float)
-            data['Current (A)'] = np.array(self.current, dtype=float)
-            data['Load (%)'] = np.array(self.load, dtype=int)
-            data['Time (sec)'] = np.array([i for i in range(num_rows)], dtype=int)
-            data['Phase'] = np.array(self.phase, dtype=int)
+            # Populate the array, the columns are views into the journal / ring and get converted once, straight into the file rows
+            data['Voltage Bottom Bound (V)'] = self.bottom_border
+            data['Voltage (V)'] = self.voltage
+            data['Voltage Top Bound (V)'] = self.top_border
+            data['Voltage Min (V)'] = self.v_min
+            data['Voltage Max (V)'] = self.v_max
+            data['Current (A)'] = self.current
+            data['Load (%)'] = self.load
+            data['Time (sec)'] = self.time
+            data['Phase'] = self.phase
             hdf.create_dataset('Measured_Data', data=data)
 
             # OPP data
@@ -525,17 +811,43 @@ class EvaluateResults:
             OPP_data['Load (%)'] = np.array(l, dtype=float)
             OPP_data['Within Spec'] = np.array(b, dtype=bool)
             hdf.create_dataset('OPP_Results', data=OPP_data)
+            hdf.create_dataset('OPP_Search', data=np.array([tuple(b) for b in self.opp_brackets], dtype=[
+                ('Held Load (%)', 'f4'),
+                ('Tripped Load (%)', 'f4'),
+                ('Overload Events', 'i4')
+            ]))
+
+            # Temperature, sampled slower and on its own clock
+            temp_data = np.zeros(len(self.temperature), dtype=[
+                ('Time (sec)', 'f4'),
+                ('Temperature (C)', 'f4')
+            ])
+            temp_data['Time (sec)'] = np.array(self.temp_time, dtype=float)
+            temp_data['Temperature (C)'] = np.array(self.temperature, dtype=float)
+            hdf.create_dataset('Temperature', data=temp_data)
+
+            # Load steps, so a step can be found without scanning the load column
+            step_data = np.array(self.steps, dtype=[
+                ('Load (%)', 'i4'),
+                ('Start Index', 'i4'),
+                ('Stop Index', 'i4'),
+                ('Start Time (sec)', 'f4')
+            ])
+            hdf.create_dataset('Load_Steps', data=step_data)
+            hdf.create_dataset('Schedule', data=self.schedule)
             self.save_graph_to_hdf5(hdf, tested_adapter)
+        self.file_name = fname
 
         msg = f"Data successfully saved into file: {fname}"
         print(colorama.Fore.BLUE + msg + colorama.Style.RESET_ALL)
         self.data_storage.add_message(msg, BLUE)
+        return fname
 
     def save_graph_to_hdf5(self, hdf_file, tested_adapter):
         fig = go.Figure()
 
         # Voltage interval (shaded area between bounds)
-        x_values = [i * 0.1 for i in range(len(self.voltage))]
+        x_values = self.time
         fig.add_trace(go.Scatter(
             x=x_values,
             y=self.bottom_border,
@@ -608,16 +920,6 @@ class EvaluateResults:
         graph_group = hdf_file.create_group('Graph')
         graph_group.create_dataset('Plotly_Figure', data=fig_json)
 
-    def add_OOB_result(self, voltage, current, load, exmin, exmax):
-        self.OOB_results.append({
-            'voltage': voltage,
-            'current': current,
-            'load': load,
-            'expected_min': exmin,
-            'expected_max': exmax
-        })
-
-
 class DisplayedTest:
     def __init__(self, fname):
         self.fname = "tests/" + fname
@@ -638,6 +940,11 @@ class DisplayedTest:
             self.p3 = "Passed" if details_group.attrs.get('Phase3_Passed') else "Failed"
             self.val = "Valid" if details_group.attrs.get('Is_Test_Valid') else "Invalid"
             self.scp = "Passed" if details_group.attrs.get('Phase3_Short_Circuit_Passed') else "Failed"
+            # Phases a fail-fast abort didn't run, files from before it don't have these
+            if details_group.attrs.get('Phase2_Skipped'):
+                self.p2 = "Skipped"
+            if details_group.attrs.get('Phase3_Skipped'):
+                self.p3 = self.scp = "Skipped"
             self.test_id = details_group.attrs.get('ID')
 
     def load_graph_from_hdf(self):
@@ -0,0 +1,75 @@
+import glob
+import os
+import threading
+import colorama
+from colors import ORANGE
+
+
+class TemperatureSampler:
+    # Reads the DS18B20 on its own thread, one read blocks for ~750ms while the sensor converts
+    def __init__(self, data_storage, clock, base_dir: str = "/sys/bus/w1/devices", interval: float = 2.0, retry_interval: float = 30.0):
+        self.data_storage = data_storage
+        self.clock = clock
+        self.base_dir = base_dir
+        self.interval = interval  # Seconds between reads
+        self.retry_interval = retry_interval  # Seconds between looking for a missing sensor
+        self.sensor_file = None
+        self.temp: float = None
+        self.failed_reads: int = 0
+        self.is_running: bool = False
+        self.thread = None
+        self._warned = False
+
+    def find_sensor(self):
+        # Resolved once, only looked up again if the sensor goes missing
+        sensor_files = glob.glob(os.path.join(self.base_dir, '28-*', 'w1_slave'))
+        self.sensor_file = sensor_files[0] if sensor_files else None
+        return self.sensor_file
+
+    def read(self):
+        # Temperature in °C, None if the sensor is missing or the CRC check failed
+        if self.sensor_file is None and self.find_sensor() is None:
+            return None
+        try:
+            with open(self.sensor_file, 'r') as f:
+                lines = f.readlines()
+        except OSError:
+            self.sensor_file = None
+            return None
+
+        if len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+            self.failed_reads += 1
+            return None
+        equals_pos = lines[1].find('t=')
+        if equals_pos == -1:
+            self.failed_reads += 1
+            return None
+        return float(lines[1][equals_pos + 2:]) / 1000.0
+
+    def run(self):
+        while self.is_running:
+            temp = self.read()
+            if temp is not None:
+                self.temp = temp
+                self.data_storage.new_temp(temp, self.clock.now_ns())
+                self.clock.sleep(self.interval)
+            elif self.sensor_file is None:
+                if not self._warned:
+                    self._warned = True
+                    msg = "DS18B20 sensor not found, temperature won't be recorded"
+                    print(colorama.Fore.YELLOW, msg, colorama.Fore.RESET)
+                    self.data_storage.add_message(msg, ORANGE)
+                self.clock.sleep(self.retry_interval)
+            else:
+                # Bad CRC, the next conversion is usually fine
+                self.clock.sleep(self.interval / 4)
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
@@ -0,0 +1,104 @@
+import threading
+import traceback
+from time import perf_counter
+
+# States of a test run, besides the ones given to TestEngine.run
+IDLE = "Idle"
+FINISHED = "Finished"
+STOPPED = "Stopped"
+
+
+class CancelToken:
+    # Cancellation of one test run. Every wait of the test honours it and returns as soon as it's cancelled,
+    # so stopping doesn't depend on a loop noticing a flag at its next poll
+    def __init__(self, clock):
+        self.clock = clock
+        self.reason = None
+        self.cancelled_at = None  # perf_counter() when cancelled, stop latency is real time even with a virtual clock
+        self._event = threading.Event()
+        self._conditions = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "Stopped"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self.cancelled_at = perf_counter()
+            self._event.set()
+            conditions = list(self._conditions)
+        for condition in conditions:
+            with condition:
+                condition.notify_all()
+
+    def wake_on_cancel(self, condition: threading.Condition):
+        # Waiters on this condition get notified when the token is cancelled
+        with self._lock:
+            self._conditions.add(condition)
+
+    def sleep(self, seconds: float) -> bool:
+        # Sleeps on the test clock, False if cancelled before the time was up
+        return not self.clock.wait(self._event, seconds)
+
+
+class TestEngine:
+    # Runs the states of one test in order on the test thread, a state returns when it's done or the token got cancelled.
+    # The time of every state on the test clock is kept for the test file, and how long it took to stop after a cancel
+    def __init__(self, clock):
+        self.clock = clock
+        self.token = CancelToken(clock)
+        self.state = IDLE
+        self.state_times = {}  # state: seconds
+        self.stop_latency = None  # Seconds from cancel() to the test thread being out of its state
+        self.aborted = None  # Reason of a fail-fast abort
+        self.aborted_in = None  # State the abort came in
+        self.error = None  # Reason the test couldn't go on, an exception in a state or a failed journal sync
+
+    def abort(self, reason: str):
+        # The test failed for sure, the remaining states are skipped like after a cancel but the final ones still run
+        if self.token.cancelled:
+            return
+        self.aborted, self.aborted_in = reason, self.state
+        self.token.cancel(reason)
+
+    def fail(self, reason: str):
+        # The test can't go on, it stops like after a cancel and not even the final states run
+        if self.error is None:
+            self.error = reason
+        self.token.cancel(reason)
+
+    def run(self, states: [(str, callable)], final: [(str, callable)] = ()) -> bool:
+        # True if every state ran to its end, or the test was aborted and the final states ran
+        for name, state in states:
+            if self.token.cancelled:
+                break
+            self._run_state(name, state)
+        if self.error is not None or (self.token.cancelled and self.aborted is None):
+            return self._stopped()
+        for name, state in final:
+            self._run_state(name, state)
+            if self.error is not None:
+                return self._stopped()
+        self.state = FINISHED
+        return True
+
+    def _stopped(self) -> bool:
+        self.stop_latency = perf_counter() - self.token.cancelled_at
+        self.state = STOPPED
+        return False
+
+    def _run_state(self, name: str, state):
+        # An exception ends the test here, on the test thread nobody else would see it and the load would stay on
+        self.state = name
+        start = self.clock.now_ns()
+        try:
+            state()
+        except Exception as e:
+            traceback.print_exc()
+            self.fail(f"{name} failed: {e}")
+        finally:
+            self.state_times[name] = (self.clock.now_ns() - start) / 1e9
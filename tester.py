@@ -1,24 +1,39 @@
+import copy
 import json
+import os
 import threading
-from email.utils import collapse_rfc2231_value
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from rpi_hardware_pwm import HardwarePWM
-from subclasses import DataStorage, AppSettings, TestableAdapters, EvaluateResults
+from statistics import NormalDist
+from email.utils import collapse_rfc2231_value
+from subclasses import DataStorage, AppSettings, TestableAdapters, EvaluateResults, PhaseResult
+from ina219_reader import conversion_time
+from hardware import RealClock, ConnectionMonitor, create_backend
+from acquisition import Sampler
+from sampler_process import SamplerProcess
+from temperature import TemperatureSampler
+from journal import SampleJournal, JOURNAL_DIR, orphaned_journals
+from test_engine import TestEngine
+from batch_queue import BatchQueue, load_batch
 from colors import BLACK, WHITE, GRAY, RED, GREEN, ORANGE, BLUE, LIGHT_BLUE, YELLOW
-import glob
-import board
-import busio
-import adafruit_ina219
-import RPi.GPIO as GPIO
+from profiles import DWELL, HOLD, OPP_SEARCH, SCHEDULE, SHORT_CIRCUIT, load_profiles, phase_bounds, phase_rows
+from calibration import OVERCURRENT, SHORTED, SHORT_CIRCUIT_LOAD, CalibrationTable
 import colorama
+import numpy as np
+
+PHASE_PROGRESS = {1: 20, 2: 20}  # Progress bar % for the load steps of phase 1 and 2
+# Fail-fast criteria for settings.fail_fast, each one ends the test as soon as it failed for sure:
+#   voltage    - a phase 1 / 2 sample out of the v_tol band, checked after every dwell like EvaluateResults does at the end
+#   regulation - every sample of a dwell below the adapter's minimum voltage, it doesn't regulate at all
+#   opp        - an OPP trip outside the adapter's OPP range
+FAIL_FAST = ("voltage", "regulation", "opp")
 
 
 class Tester:
-    def __init__(self):
-        self.voltage: float = 0.0
-        self.current: float = 0.0
-        self.temp: float = 0.0
+    def __init__(self, backend=None):
+        self.bucket_period: float = .1  # Seconds per stored sample, raw samples are aggregated into these
+        self.sampler = Sampler(self.bucket_period)  # Replaced by a SamplerProcess in setup() if enabled in settings
+        self.temp_sampler = None
         self.data_storage = DataStorage()
         self.settings = AppSettings()
         self.testable_adapters = TestableAdapters()
@@ -26,46 +41,103 @@ class Tester:
         self.test_values = {}
         self.progress: int = 0
         self.is_running: bool = False
-        self.is_measuring: bool = True
         self.debug: bool = False
         self.is_connected: bool = False
         self.update_ptd: bool = True
         self.update_ptd: bool = True
         self.connection_pin = 23
         self.running_signal_pin = 24
+        self.backend = backend  # Hardware access, created from settings in setup() if not given
+        self.connection = None  # ConnectionMonitor on connection_pin
+        self.clock = RealClock()
         self.pwm = None  
-        self.ina219 = None
         self.v_a_thread = None
         self.pwm_thread = None
         self.test_thread = None
+        self.engine = None  # TestEngine of the current / last test, its token cancels every wait of the test
+        self.profiles = {}  # name: profiles.TestProfile, from profiles.json
+        self.default_profile = None
+        self.profile = None  # TestProfile of the running test
+        self.schedule = np.zeros(0, dtype=SCHEDULE)  # Compiled from the profile when a test starts
+        self.setpoints = {}  # load: (PWM duty, calibration mode) of the running test's schedule loads, for the PWM thread
+        # Evaluates finished phases while the test goes on and writes the test files, one job at a time so files are written in order
+        self.results_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="results")
+        self.phase_evals = {}  # phase: Future of its PhaseResult, for the running test
+        self.batch: BatchQueue = None  # Queue mode, tests start by themselves when a unit gets plugged in
+        self.serial = None  # Serial number of the unit under test, if the batch has one
+        self._batch_lock = threading.Lock()
+        self.phase3_row_times = {}  # profile: seconds per phase 3 step of the last full test, for the fail-fast time estimate
         self.percent_load_on_adapter: float = 0  # In % I think ?
         self.applied_pwm_duty: float = 0
         self.wait_to_stop = False
+        self.journal = None  # SampleJournal of the running test
+        self.journal_thread = None
+        self.journal_interval: float = 1.0  # Seconds between journal syncs, at most this much of a test is lost in a crash
+        self.journaled: int = 0  # Samples already in the journal
+        self._journal_lock = threading.Lock()
 
     def setup(self):
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.connection_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(22, GPIO.OUT)
-        GPIO.setup(27, GPIO.OUT)
-        GPIO.setup(17, GPIO.OUT)
-        GPIO.setup(self.running_signal_pin, GPIO.OUT)
-        self.ina219 = adafruit_ina219.INA219(busio.I2C(board.SCL, board.SDA))
-        self.ina219.set_calibration_32V_2A()
-        if self.settings.high_res:
-            self.switch_to_high_res()
+        if self.backend is None:
+            self.backend = create_backend(self.settings)
+        self.clock = self.backend.clock
+        self.backend.setup_gpio([self.connection_pin], [22, 27, 17, self.running_signal_pin])
+        if self.settings.sampler_process:
+            # Forked first, before the threads below exist
+            sampler = SamplerProcess(self.backend, self.bucket_period)
+            sampler.load, sampler.connected, sampler.debug = self.sampler.load, self.sampler.connected, self.debug
+            self.sampler = sampler
+            self.data_storage.use_rings(sampler.samples, sampler.seconds)
+            self.apply_adc_mode()
+            self.sampler.start()
         else:
-            self.switch_to_low_res()
+            self.sampler.reader = self.backend.create_sensor()
+            self.apply_adc_mode()
+            self.v_a_thread = threading.Thread(target=self.get_V_A)
+            self.v_a_thread.start()
+        self.connection = ConnectionMonitor(self.backend, self.connection_pin)
+        self.connection.subscribe(self.on_connection_change)
+        self.is_connected = self.connection.start()
 
-        self.pwm = HardwarePWM(pwm_channel=0, hz=60, chip=0)
-        self.pwm.change_frequency(10000)
-        self.v_a_thread = threading.Thread(target=self.get_V_A)
-        self.v_a_thread.start()
+        self.pwm = self.backend.create_pwm()
+        self.temp_sampler = TemperatureSampler(self.data_storage, self.clock)
+        self.temp_sampler.start()
         self.set_res_list()
         self.testable_adapters.load_values()
+        self.profiles, self.default_profile, errors = load_profiles()
+        for msg in errors:
+            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, RED)
+        orphans = orphaned_journals()
+        if orphans:
+            msg = f"Found {len(orphans)} unfinished test(s) from a crash, run 'python journal.py recover' to save them as test files"
+            print(colorama.Fore.YELLOW, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, ORANGE)
+        for criterion in set(self.settings.fail_fast) - set(FAIL_FAST):
+            msg = f"Unknown fail-fast criterion {criterion} in conf.json, use any of {', '.join(FAIL_FAST)}"
+            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, RED)
+        if self.settings.batch_file:
+            self.load_batch(self.settings.batch_file)
         #self.flash_LED(1)
 
-    def start(self):
+    def start(self, profile: str = None):
+        # profile overrides the batch's / adapter's one, used by the simulation runner
         if not self.is_running and self.is_connected:
+            name = profile or (self.batch and self.batch.profile) or self.testable_adapters.selected_adapter.profile or self.default_profile
+            if name not in self.profiles:
+                msg = f"Test profile {name} not found in profiles.json, can't start the test"
+                print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+                self.data_storage.add_message(msg, RED)
+                return
+            self.profile = self.profiles[name]
+            self.schedule = self.profile.compile(self.settings.phase1, self.settings.phase2, self.settings.phase3, self.samples_for)
+            try:
+                self.setpoints = self.compile_setpoints()
+            except ValueError as e:
+                msg = f"{e}, can't start the test"
+                print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+                self.data_storage.add_message(msg, RED)
+                return
             self.is_running = True
             self.turn_on_yellow_LED()
             self.flash_LED_controller("red", 1)
@@ -76,12 +148,151 @@ class Tester:
             self.pwm_thread.start()
             self.progress = 1
             self.data_storage.clear()
-            self.test_thread = threading.Thread(target=self.phase1)
+            self.data_storage.testing = True
+            self.engine = TestEngine(self.clock)
+            self.phase_evals = {}
+            try:
+                self.start_journal()
+            except (ValueError, OSError) as e:
+                # The load is already on, it's taken off like after a stop
+                msg = f"Couldn't create the test journal, test stopped: {e}"
+                print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+                self.data_storage.add_message(msg, RED)
+                self.stop(False)
+                self.test_stopped()
+                return
+            self.test_thread = threading.Thread(target=self.run_test)
             self.test_thread.start()
 
+    def start_journal(self):
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        adapter = self.testable_adapters.selected_adapter
+        meta = {
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "adapter": [adapter.name, adapter.max_current, adapter.max_voltage, adapter.min_voltage, adapter.v_tol, adapter.OPP_min, adapter.OPP_max, adapter.profile],
+            "phases": [self.settings.phase1, self.settings.phase2, self.settings.phase3],
+            "profile": self.profile.name,
+            "serial": self.serial,
+            "test_values": self.test_values,
+        }
+        path = os.path.join(JOURNAL_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.journal")
+        with self._journal_lock:
+            self.journal = SampleJournal(path, meta=meta, schedule=self.schedule)
+            self.journaled = 0
+        self.journal_thread = threading.Thread(target=self.journal_loop, daemon=True)
+        self.journal_thread.start()
+
+    def journal_loop(self):
+        token = self.engine.token
+        while not token.cancelled and self.journal is not None:
+            self.sync_journal()
+            token.sleep(self.journal_interval)
+
+    def sync_journal(self) -> bool:
+        # New samples and the phase indices so far go into the journal, then it's synced to the card.
+        # A test that can't be journaled is stopped, False then
+        with self._journal_lock:
+            if self.journal is None:
+                return True
+            try:
+                snap = self.data_storage.snapshot(self.journaled)
+                if snap.start > self.journaled:
+                    # The ring came around to samples before they were journaled (a shared ring can't grow). The journal's records
+                    # are indexed like the ring, with a gap every index after it would point at the wrong sample
+                    self.engine.fail(f"Samples {self.journaled} to {snap.start - 1} were overwritten before they were journaled")
+                    return False
+                self.journal.append(snap[1:])
+                self.journaled = snap.start + len(snap.timestamps)
+                self.journal.set_schedule(self.schedule)
+                self.journal.set_meta({"test_values": self.test_values})
+                self.journal.sync()
+            except (ValueError, OSError) as e:
+                # Also from the journal thread, the test thread posts the message when it's out of its state
+                self.engine.fail(f"Couldn't write the test journal: {e}")
+                return False
+        return True
+
+    def end_journal(self):
+        # Only for tests that ended without a crash, finished or stopped
+        with self._journal_lock:
+            if self.journal is not None:
+                self.journal.delete()
+                self.journal = None
+
+    def load_batch(self, path: str):
+        try:
+            batch = load_batch(path)
+        except (OSError, ValueError) as e:
+            msg = f"Couldn't load the batch {path}: {e}"
+            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, RED)
+            return
+        names = [a.name for a in self.testable_adapters.adapters]
+        unknown = sorted({unit.adapter for unit in batch.units if unit.adapter not in names})
+        if unknown or (batch.profile and batch.profile not in self.profiles):
+            msg = f"Couldn't load the batch {path}: unknown adapters {unknown} or profile {batch.profile}"
+            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, RED)
+            return
+        self.batch = batch
+        msg = f"Batch {path} loaded, {len(batch.units)} units, plug in the first one"
+        print(colorama.Fore.BLUE, msg, colorama.Fore.RESET)
+        self.data_storage.add_message(msg, BLUE)
+        # A unit that is already plugged in counts as new
+        self.batch_next()
+
+    def batch_next(self):
+        # Starts the test of the next unit in the batch once a new one is plugged in and the station is free.
+        # Called on every connection change and when a test ended
+        with self._batch_lock:
+            batch = self.batch
+            if batch is None:
+                return
+            if not self.is_connected:
+                batch.needs_removal = False
+                if not (self.is_running or self.wait_to_stop):
+                    self.turn_off_LEDS()
+                return
+            if self.is_running or self.wait_to_stop or batch.needs_removal or batch.done:
+                return
+            self.clock.sleep(batch.settle)
+            if not self.is_connected:
+                return
+            unit = batch.current
+            self.testable_adapters.select_adapter([a.name for a in self.testable_adapters.adapters].index(unit.adapter))
+            self.serial = unit.serial
+            msg = f"Batch unit {batch.position + 1}/{len(batch.units)} ({unit.serial or unit.adapter}) plugged in, starting the test"
+            print(colorama.Fore.BLUE, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, BLUE)
+            self.start()
+            if self.is_running:
+                batch.unit_started(self.clock.now_ns())
+
+    def batch_unit_done(self, passed: bool):
+        # Pass / fail stays on the LEDs until the unit is unplugged
+        batch = self.batch
+        batch.unit_finished(passed, self.clock.now_ns())
+        if passed:
+            self.turn_on_green_LED()
+        else:
+            self.turn_off_green_LED()
+            self.turn_on_red_LED()
+        idle = batch.idle_times()
+        msg = f"Unit {batch.results[-1].unit.serial or batch.position} {'passed' if passed else 'failed'}, " \
+              f"{batch.units_per_hour():.1f} units/hour" + (f", {idle[-1]:.1f}s idle before it" if idle else "")
+        print(colorama.Fore.BLUE, msg, colorama.Fore.RESET)
+        self.data_storage.add_message(msg, BLUE)
+        if batch.done:
+            msg = f"Batch finished: {batch.summary()}"
+            print(colorama.Fore.BLUE, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, BLUE)
+            self.batch = None
+
     def start_constant_load(self, load: float):
         if not self.is_running and self.is_connected:
             self.is_running = True
+            # No schedule, every load converts for the selected adapter
+            self.setpoints = {}
             self.flash_LED_controller("yellow", 3)
             self.turn_on_signal()
             self.pwm.start(0)
@@ -89,111 +300,138 @@ class Tester:
             self.pwm_thread.start()
             self.percent_load_on_adapter = (load / self.testable_adapters.selected_adapter.max_current) * 100  # Amps to % load
 
-    def switch_to_high_res(self):
-        self.ina219.bus_adc_resolution = adafruit_ina219.ADCResolution.ADCRES_12BIT_1S
-        self.ina219.shunt_adc_resolution = adafruit_ina219.ADCResolution.ADCRES_12BIT_1S
-        msg = "Switched to High Resolution"
+    def apply_adc_mode(self):
+        self.sampler.set_adc_mode(self.settings.adc_mode, self.raw_period())
+        msg = f"Switched ADC mode to {self.settings.adc_mode}, {self.raw_period() * 1000:.2f}ms per raw sample"
         print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
         self.data_storage.add_message(msg, GRAY)
 
-    def switch_to_low_res(self):
-        self.ina219.bus_adc_resolution = adafruit_ina219.ADCResolution.ADCRES_9BIT_1S
-        self.ina219.shunt_adc_resolution = adafruit_ina219.ADCResolution.ADCRES_9BIT_1S
-        msg = "Switched to Low Resolution"
-        print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
-        self.data_storage.add_message(msg, GRAY)
+    def raw_period(self) -> float:
+        # Time between two raw sensor reads in seconds, as fast as the ADC mode converts unless capped in settings
+        return max(conversion_time(self.settings.adc_mode), 1 / self.settings.max_raw_sample_rate)
+
+    def samples_for(self, seconds: float) -> int:
+        # Number of stored (decimated) samples that cover the given time
+        return max(1, round(seconds / self.bucket_period))
+
+    # Sampler state, the sampler may run in another process so these are only read through it
+    @property
+    def percent_load_on_adapter(self) -> float:
+        return self.sampler.load
+
+    @percent_load_on_adapter.setter
+    def percent_load_on_adapter(self, value: float):
+        self.sampler.load = value
+
+    @property
+    def is_connected(self) -> bool:
+        return self.sampler.connected
+
+    @is_connected.setter
+    def is_connected(self, value: bool):
+        self.sampler.connected = value
+
+    @property
+    def voltage(self) -> float:
+        return self.sampler.voltage
+
+    @property
+    def current(self) -> float:
+        return self.sampler.current
+
+    @property
+    def achieved_rate(self) -> float:
+        return self.sampler.achieved_rate
+
+    @property
+    def overruns(self) -> int:
+        return self.sampler.overruns
+
+    @property
+    def dropped_samples(self) -> int:
+        return self.sampler.dropped_samples
 
     def get_V_A(self):
-        ts = 0
-        while True:
-            if not self.is_measuring:
-                return
-            if ts == 10:
-                ts = 0
-                self.connected_check()
+        # Sampling in a thread of this process, raw samples are read as fast as the ADC mode allows, only the 100ms and 1s buckets get stored
+        buckets = 0
+
+        def on_bucket(bucket):
+            nonlocal buckets
+            if buckets % 10 == 0:
                 if self.debug:
                     msg = f"""
 Vals: 
-     Voltage: {self.voltage}V; 
-     Amps: {self.current} A;
-     Shunt: {self.ina219.shunt_voltage}V;
-     Calcd_Amps: {self.ina219.shunt_voltage / 0.1}A;
-     Connection: {self.is_connected};"""
+     Voltage: {bucket.v_mean}V ({bucket.v_min} - {bucket.v_max}V); 
+     Amps: {bucket.a_mean} A;
+     Shunt: {self.sampler.reader.shunt_voltage}V;
+     Stale polls: {self.sampler.reader.stale_polls};
+     Read timeouts: {self.sampler.reader.timeouts};
+     Connection: {self.is_connected};
+     Raw rate: {self.achieved_rate:.2f} Hz;
+     Samples in bucket: {bucket.count};
+     Overruns: {self.overruns};
+     Dropped: {self.dropped_samples};"""
                     print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
                     self.data_storage.add_message(msg, GRAY)
-                if not self.is_connected:
-                    self.voltage = 0.00
-
-            self.voltage = float(self.ina219.bus_voltage)
-            self.current = float(self.ina219.current / 1000.0)
-            self.data_storage.new_values(self.voltage, self.current, self.percent_load_on_adapter, self.is_connected)
-            ts += 1
-            # Timeout based on settings
-            if self.settings.high_res:
-                # Takes about .5 sec between hw measurments
-                sleep(.5)
-            elif not self.settings.high_res:
-                if self.settings.per_sec:
-                    # Slower, once per sec
-                    sleep(1)
-
-                elif not self.settings.per_sec:
-                    # At low res (9BIT), all data
-                    sleep(.1)
-            else:
-                raise AssertionError("This is a big problem. Something is wrong in the settings.")
+            buckets += 1
+            self.data_storage.new_values(bucket, self.percent_load_on_adapter, self.is_connected)
+
+        def on_second(second):
+            self.data_storage.new_second(second, self.percent_load_on_adapter, self.is_connected)
+
+        self.sampler.run(self.clock, on_bucket, on_second)
 
     def turn_on_signal(self):
-        GPIO.output(self.running_signal_pin, GPIO.HIGH)
+        self.backend.output(self.running_signal_pin, True)
         if self.debug:
             msg = f"HW signal is now on. Pin: {self.running_signal_pin}"
             print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
             self.data_storage.add_message(msg, GRAY)
 
     def turn_off_signal(self):
-        GPIO.output(self.running_signal_pin, GPIO.LOW)
+        self.backend.output(self.running_signal_pin, False)
         if self.debug:
             msg = f"HW signal is now off. Pin: {self.running_signal_pin}"
             print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
             self.data_storage.add_message(msg, GRAY)
 
     def turn_on_red_LED(self):
-        GPIO.output(22, GPIO.HIGH)
+        self.backend.output(22, True)
         if self.debug:
             msg = "LED is now on"
             print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
             self.data_storage.add_message(msg, GRAY)
 
     def turn_off_red_LED(self):
-        GPIO.output(22, GPIO.LOW)
+        self.backend.output(22, False)
         if self.debug:
             msg = "LED is now off"
             print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
             self.data_storage.add_message(msg, GRAY)
 
     def turn_on_yellow_LED(self):
-        GPIO.output(27, GPIO.HIGH)
+        self.backend.output(27, True)
         if self.debug:
             msg = "LED is now on"
             print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
             self.data_storage.add_message(msg, GRAY)
 
     def turn_off_yellow_LED(self):
-        GPIO.output(27, GPIO.LOW)
+        self.backend.output(27, False)
         if self.debug:
             msg = "LED is now off"
             print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
             self.data_storage.add_message(msg, GRAY)
 
     def turn_on_green_LED(self):
-        GPIO.output(17, GPIO.HIGH)
+        self.backend.output(17, True)
         if self.debug:
             msg = "LED is now on"
             print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
             self.data_storage.add_message(msg, GRAY)
 
     def turn_off_green_LED(self):
-        GPIO.output(17, GPIO.LOW)
+        self.backend.output(17, False)
         if self.debug:
             msg = "LED is now off"
             print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
@@ -218,48 +456,42 @@ Vals:
 
     def flash_red_LED(self, t):
         self.turn_on_red_LED()
-        sleep(t)
+        self.clock.sleep(t)
         self.turn_off_red_LED()
 
     def flash_green_LED(self, t):
         self.turn_on_green_LED()
-        sleep(t)
+        self.clock.sleep(t)
         self.turn_off_green_LED()
 
     def flash_yellow_LED(self, t):
         self.turn_on_yellow_LED()
-        sleep(t)
+        self.clock.sleep(t)
         self.turn_off_yellow_LED()
 
+    @property
+    def temp(self) -> float:
+        return self.temp_sampler.temp if self.temp_sampler else None
+
     def connected_check(self):
-        if GPIO.input(self.connection_pin) == GPIO.LOW:
-            self.is_connected = False
+        self.is_connected = self.backend.input(self.connection_pin)
+
+    def on_connection_change(self, connected: bool):
+        # Called from the GPIO event thread as soon as the adapter is plugged in or out
+        self.is_connected = connected
+        if connected:
+            msg = "Adapter connected"
+            print(colorama.Fore.BLUE, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, BLUE)
         else:
-            self.is_connected = True
-
-    def read_temp_raw(self):
-        sensor_files = glob.glob('/sys/bus/w1/devices/28-*/w1_slave')
-        if not sensor_files:
-            raise Exception("DS18B20 sensor not found")
-
-        sensor_file = sensor_files[0]
-        with open(sensor_file, 'r') as f:
-            lines = f.readlines()
-        return lines
-
-    def get_temp(self):
-        lines = self.read_temp_raw()
-        while lines[0].strip()[-3:] != 'YES':
-            sleep(0.2)
-            lines = self.read_temp_raw()
-        equals_pos = lines[1].find('t=')
-        if equals_pos != -1:
-            temp_string = lines[1][equals_pos + 2:]
-            temp_c = float(temp_string) / 1000.0
-            self.temp = temp_c
-            self.data_storage.new_temp(self.temp)
-            if self.debug:
-                print(colorama.Fore.LIGHTBLACK_EX, "Temperature: {:.1f} °C".format(temp_c), colorama.Fore.RESET)
+            msg = "Adapter disconnected"
+            print(colorama.Fore.YELLOW, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, ORANGE)
+            if self.is_running:
+                # Don't block the event thread with the stop sequence
+                threading.Thread(target=self.stop, args=([False])).start()
+        if self.batch is not None:
+            threading.Thread(target=self.batch_next).start()
 
     def start_calibration(self):
         self.pwm_thread = threading.Thread(target=self.calibrate)
@@ -270,7 +502,7 @@ Vals:
         # keep highest if ==
         calibrated = {}
         self.pwm.start(10)
-        sleep(5)
+        self.clock.sleep(5)
         self.turn_on_LED()
         to_define = [4.0, 4.5, 5.0, 5.5, 6.0, 6.5, 7.0, 7.5, 8.0, 8.5, 9.0, 9.5, 10.0, 10.2, 10.4, 10.6, 10.8, 11.0, 11.2, 11.4, 11.6, 11.8, 12.0, 12.2, 12.4, 12.6, 12.8, 13.0, 13.2, 13.4, 13.6, 13.8, 14.0, 14.2, 14.4, 14.6, 14.8, 15.0, 15.2, 15.4, 15.6, 15.8, 16.0, 16.2, 16.4, 16.6, 16.8, 17.0, 17.2, 17.4, 17.6, 17.8, 18.0, 18.2, 18.4, 18.6, 18.8, 19.0, 19.2, 19.4, 19.6, 19.8, 20.0]
         msg = "Calibration In progress DO NOT UNPLUG THE ADAPTER"
@@ -278,7 +510,7 @@ Vals:
         self.data_storage.add_message(msg, RED)
         for pwm_percent in to_define:
             self.pwm.change_duty_cycle(pwm_percent)
-            sleep(.2)
+            self.clock.sleep(.2)
             calibrated[round(self.current, 2)] = pwm_percent
             self.progress = self.progress + (100 / len(to_define))
             print(f"{self.progress} % done, please wait")
@@ -288,56 +520,34 @@ Vals:
         print(colorama.Fore.GREEN, msg, colorama.Style.RESET_ALL)
         self.data_storage.add_message(msg, GREEN)
         self.progress = 100
-        self.settings.pwm_mappings = calibrated
+        self.settings.pwm_mappings = sorted((pwm, current) for current, pwm in calibrated.items())
+        self.settings.calibration = CalibrationTable(self.settings.pwm_mappings)
         self.pwm.stop()
         self.turn_off_LED()
-        sleep(2)
+        self.clock.sleep(2)
         self.progress = 0
 
     def change_pwm(self):
+        # PWM thread, the duties of the schedule's loads were converted when the test started, only the OPP probes are looked up
         last_percent_load_on_adapter = 0
+        max_current = self.testable_adapters.selected_adapter.max_current
         while self.is_running:
-            if last_percent_load_on_adapter != self.percent_load_on_adapter:
-                current1 = None
-                current2 = None
-                target_current = (self.percent_load_on_adapter / 100) * self.testable_adapters.selected_adapter.max_current  # pwm changed from % to amps
-                for i in range(len(self.settings.pwm_mappings) - 1):
-                    pwm1, current1 = self.settings.pwm_mappings[i]
-                    pwm2, current2 = self.settings.pwm_mappings[i + 1]
-
-                    if self.percent_load_on_adapter == 2111333:
-                        # Testing shortcircuit
-                        self.applied_pwm_duty = 100
-                        break
-                    elif current1 == target_current:
-                        self.applied_pwm_duty = pwm1
-                        break
-                    elif current2 == target_current:
-                        self.applied_pwm_duty = pwm2
-                        break
-                    elif current1 < target_current < current2:
-                        # Interpolate if not exact
-                        ratio = (target_current - current1) / (current2 - current1)
-                        self.applied_pwm_duty = pwm1 + ratio * (pwm2 - pwm1)
-                        if self.applied_pwm_duty > 100:
-                            self.applied_pwm_duty = 100
-                        break
-                    elif 3.2 < target_current < 3.5:
-                        self.applied_pwm_duty = 75
-                        msg = f"Reached max current of 3.2A"
-                        self.data_storage.add_message(msg, RED)
-                        print(colorama.Fore.RED, msg, colorama.Style.RESET_ALL)
-                        break
+            load = self.percent_load_on_adapter
+            if last_percent_load_on_adapter != load:
+                if load in self.setpoints:
+                    self.applied_pwm_duty, mode = self.setpoints[load]
                 else:
-                    msg = f"Error: Wanted current is not within expected range; {current1} < {target_current} < {current2}"
+                    self.applied_pwm_duty, mode = self.settings.calibration.duty(load, max_current)
+                target_current = (load / 100) * max_current  # pwm changed from % to amps
+                if mode == OVERCURRENT:
+                    msg = f"Reached max current of {self.settings.calibration.max_current}A"
                     self.data_storage.add_message(msg, RED)
-                    raise ValueError(msg)
-
+                    print(colorama.Fore.RED, msg, colorama.Style.RESET_ALL)
 
                 try:
                     self.pwm.change_duty_cycle(self.applied_pwm_duty)
-                    last_percent_load_on_adapter = self.percent_load_on_adapter
-                    msg = f"Expected current: {target_current}; Selected PWM: {self.applied_pwm_duty}"
+                    last_percent_load_on_adapter = load
+                    msg = "Short circuit: Selected PWM: 100" if mode == SHORTED else f"Expected current: {target_current}; Selected PWM: {self.applied_pwm_duty}"
                     self.data_storage.add_message(msg, GRAY)
                     print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Style.RESET_ALL)
                 except Exception as e:
@@ -345,7 +555,13 @@ Vals:
                     self.data_storage.add_message(msg, RED)
                     raise ValueError(msg)
 
-            sleep(.1)
+            self.clock.sleep(.1)
+
+    def compile_setpoints(self) -> {float: (float, int)}:
+        # load: (duty, mode) of every load the schedule sets and the short circuit, converted in one call
+        loads = np.unique(np.append(self.schedule["load"], [0, SHORT_CIRCUIT_LOAD]))
+        duties, modes = self.settings.calibration.duties(loads, self.testable_adapters.selected_adapter.max_current)
+        return {float(load): (float(duty), int(mode)) for load, duty, mode in zip(loads, duties, modes)}
 
     def set_res_list(self):
         self.test_values = None
@@ -363,207 +579,426 @@ Vals:
                 "stop_index": 0,
                 "OPP_trip_index": [],
                 "OPP_trip_load": [],
+                "OPP_brackets": [],  # [highest load held, lowest load tripped, overload events] of every OPP search
                 "short_circuit": False,
             }
         ]
 
-    def phase1(self):
-        self.progress += 10
-        msg = f"Phase 1:\n    - Testing standard load increase\n    - Testing loads between 0% and 100% \n    - Repeating test {self.settings.phase1[1]} times\n"
+    def run_test(self):
+        # Test thread, the phases are states of the test engine, each one runs only if the test wasn't cancelled during the one before
+        # A fail-fast abort skips the remaining phases but still writes the file
+        if self.engine.run([("Phase1", self.phase1), ("Phase2", self.phase2), ("Phase3", self.phase3)], [("Results", self.parse_results)]):
+            self.finish_test()
+            return
+        if self.is_running:
+            # Cancelled by the test itself, not by stop()
+            self.stop(False)
+        if self.engine.error is not None:
+            msg = f"{self.engine.error}, test stopped"
+            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, RED)
+        else:
+            msg = f"{self.engine.token.reason}: test stopped {self.engine.stop_latency * 1000:.0f}ms after the cancel"
+            print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, GRAY)
+        self.test_stopped()
+
+    def phase_message(self, phase: int, *extra: str):
+        lines = self.profile.description[phase] + [f"Repeating test {[self.settings.phase1, self.settings.phase2, self.settings.phase3][phase - 1][1]} times"] + list(extra)
+        msg = f"Phase {phase}:\n" + "".join(f"    - {line}\n" for line in lines)
         print(colorama.Fore.GREEN, msg, colorama.Fore.RESET)
         self.data_storage.add_message(msg, GREEN)
-        if self.settings.phase1[0]:
-            start_index = len(self.data_storage.voltage) - 1
 
-            for reps in range(self.settings.phase1[1]):
-                for pwm_val in range(10, 110, 10):
-                    self.percent_load_on_adapter = pwm_val
-                    while self.data_storage.load.count(pwm_val) < 10 and self.is_running:
-                        # To make sure that each load level is exactly 1s
-                        sleep(.1)
-                    self.progress += 2 / self.settings.phase1[1]
+    def run_steps(self, phase: int):
+        # Scheduler for the load steps of a phase, dwells wait on the sample count at their load, holds only on the clock.
+        # Every row gets the sample indices it ran between, the phase bounds for the evaluation come from those
+        token = self.engine.token
+        rows = phase_rows(self.schedule, phase)
+        dwells = max(1, np.count_nonzero(self.schedule["kind"][rows] == DWELL))
+        adaptive = self.profile.adaptive.get(phase)
+        settled = self.settled_check(adaptive) if adaptive else None
+        for i in rows:
+            if token.cancelled:
+                break
+            row = self.schedule[i]
+            start = self.data_storage.last_index() + 1
+            self.percent_load_on_adapter = int(row["load"])
+            if row["kind"] == DWELL:
+                samples = int(row["samples"])
+                if settled is not None:
+                    used = self.data_storage.wait_for_settled(int(row["load"]), start, min(adaptive["min_samples"], samples), samples, settled, token)
+                else:
+                    used = samples if self.data_storage.wait_for_load(int(row["load"]), samples, start, token) else None
+                if used is not None:
+                    self.schedule["used"][i] = used
+                self.progress += PHASE_PROGRESS[phase] / dwells
+            else:
+                token.sleep(float(row["seconds"]))
+            self.schedule["start"][i], self.schedule["stop"][i] = start, self.data_storage.last_index() + 1
+            if row["kind"] == DWELL and not token.cancelled:
+                self.check_dwell(phase, i)
+        start_index, stop_index = phase_bounds(self.schedule, phase)
+        if stop_index and self.schedule["load"][rows][self.schedule["kind"][rows] == DWELL][0] > 0:
+            # Remove any preceding 0s in the results
+            start_index = self.data_storage.next_load_index(start_index) or start_index
+        self.test_values[phase - 1]["start_index"] = start_index
+        self.test_values[phase - 1]["stop_index"] = stop_index
+        if settled is not None and not token.cancelled:
+            ran = self.schedule[rows][self.schedule["used"][rows] >= 0]
+            msg = f"Adaptive dwell: phase {phase} took {ran['used'].sum()} of {ran['samples'].sum()} samples"
+            print(colorama.Fore.LIGHTBLACK_EX, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, GRAY)
+
+    def settled_check(self, adaptive: dict):
+        # Voltage of a dwell is settled once its mean is known to the tolerance at the confidence, and the next sample's raw extremes
+        # would stay inside the band EvaluateResults checks at that confidence too. A step that could still fail runs its whole dwell
+        adapter = self.testable_adapters.selected_adapter
+        v_bottom, v_top = self.results.voltage_bounds(adapter)
+        z = NormalDist().inv_cdf((1 + adaptive["confidence"]) / 2)
+        half_width = adaptive["tolerance"] / 100 * adapter.max_voltage
 
-                self.percent_load_on_adapter = 0
-                sleep(.1)
-            stop_index = len(self.data_storage.voltage) - 1
-            # Remove any trailing or preceding 0s in the results
-            while self.data_storage.load[start_index] == 0 and self.is_running:
-                start_index += 1
-            while self.data_storage.load[stop_index] > 0 and self.is_running:
-                try:
-                    stop_index += 1
-                    # This is fine its here to stop the loop
-                    self.data_storage.load[stop_index]
-                except IndexError:
-                    break
-            self.test_values[0]["start_index"] = start_index
-            self.test_values[0]["stop_index"] = stop_index
+        def settled(voltage: np.ndarray, v_min: np.ndarray, v_max: np.ndarray) -> bool:
+            n = len(voltage)
+            if v_min.min() < v_bottom or v_max.max() > v_top:
+                return False
+            if z * voltage.std(ddof=1) / np.sqrt(n) > half_width:
+                return False
+            # Prediction interval of one more sample
+            spread = z * np.sqrt(1 + 1 / n)
+            return v_min.mean() - spread * v_min.std(ddof=1) >= v_bottom and v_max.mean() + spread * v_max.std(ddof=1) <= v_top
+        return settled
 
-        if self.is_running:
-            self.phase2()
-        else:
-            self.test_stopped(),
+    def check_dwell(self, phase: int, row: int):
+        # Fail-fast after a dwell, phase 1 / 2 are checked like EvaluateResults will, from the start of the phase's range to here.
+        # Out of bounds samples stay in that range, so a failure now is the phase's result at the end too
+        adapter = self.testable_adapters.selected_adapter
+        start, stop = int(self.schedule["start"][row]), int(self.schedule["stop"][row])
+        if "regulation" in self.settings.fail_fast:
+            snap = self.data_storage.snapshot(start, stop)
+            if len(snap.voltage) and snap.voltage.max() < adapter.min_voltage:
+                self.fail_fast(f"Adapter doesn't regulate, under {adapter.min_voltage}V for the whole {int(self.schedule['load'][row])}% step")
+                return
+        if "voltage" in self.settings.fail_fast:
+            first = self.test_values[0]["stop_index"] if phase == 2 else 0
+            snap = self.data_storage.snapshot(first, stop)
+            res = self.results.eval_phase(phase, 0, len(snap.voltage), snap.voltage, snap.current, snap.load, snap.v_min, snap.v_max, adapter)
+            if not res.passed:
+                self.fail_fast(f"Phase {phase} failed, {len(res.OOB_results)} samples out of the voltage bounds")
+
+    def check_opp(self):
+        # Fail-fast after an OPP search, a trip outside the adapter's range fails phase 3 in EvaluateResults whatever the other searches find
+        if "opp" not in self.settings.fail_fast or not self.test_values[2]["OPP_trip_index"]:
+            return
+        adapter = self.testable_adapters.selected_adapter
+        index = self.test_values[2]["OPP_trip_index"][-1]
+        load = self.data_storage.snapshot(index, index + 1).load
+        if len(load) and not adapter.OPP_min < load[0] < adapter.OPP_max:
+            self.fail_fast(f"OPP trip at {load[0]}%, outside {adapter.OPP_min}% - {adapter.OPP_max}%")
+
+    def fail_fast(self, reason: str):
+        # Ends the test at a definitive failure, the results and the file are still made from what ran
+        self.results.time_saved = self.remaining_time()
+        self.engine.abort(f"Fail-fast: {reason}")
+        phase3_left = np.count_nonzero((self.schedule["phase"] == 3) & (self.schedule["stop"] < 0))
+        estimate = "at least" if phase3_left and self.profile.name not in self.phase3_row_times else "about"
+        msg = f"Fail-fast: {reason}, ending the test {estimate} {self.results.time_saved:.0f}s early"
+        print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+        self.data_storage.add_message(msg, RED)
+
+    def remaining_time(self) -> float:
+        # Seconds the rest of the schedule would have taken. Phase 3 steps take as long as they did in the last full test of the
+        # profile, before there was one only as long as they take at least
+        rest = self.schedule[self.schedule["stop"] < 0]
+        seconds = float(rest["samples"][rest["kind"] == DWELL].sum()) * self.bucket_period
+        seconds += float(rest["seconds"][rest["kind"] == HOLD].sum())
+        if self.profile.name in self.phase3_row_times:
+            return seconds + np.count_nonzero(rest["phase"] == 3) * self.phase3_row_times[self.profile.name]
+        seconds += np.count_nonzero(rest["kind"] == OPP_SEARCH) * self.profile.opp["probe"]
+        seconds += np.count_nonzero(rest["kind"] == SHORT_CIRCUIT) * self.settings.phase3[2] * self.profile.short_circuit["hold"]
+        return seconds
+
+    def end_early(self):
+        # After a fail-fast abort the phases that didn't run become empty ranges where the test ended, the phase that was cut short
+        # keeps what it ran. The file has every sample up to the abort
+        aborted = int(self.engine.aborted_in[-1])  # "Phase<n>"
+        if aborted == 3:
+            self.test_values[2]["stop_index"] = self.data_storage.last_index()
+        end = self.test_values[aborted - 1]["stop_index"]
+        included = (self.settings.phase1[0], self.settings.phase2[0], self.settings.phase3[0])
+        for phase in range(aborted + 1, 4):
+            self.test_values[phase - 1]["start_index"] = self.test_values[phase - 1]["stop_index"] = end
+        self.results.skipped = [phase for phase in range(aborted + 1, 4) if included[phase - 1]]
+        self.results.fail_fast = self.engine.aborted
+
+    def phase1(self):
+        self.progress += 10
+        self.phase_message(1)
+        self.run_steps(1)
+        self.evaluate_phase(1)
 
     def phase2(self):
-        msg = f"Phase 2:\n    - Testing transient load\n    - Testing loads between 0% and 100% \n    - Testing sharp changes in load\n    - Repeating test {self.settings.phase1[1]} times\n"
-        print(colorama.Fore.GREEN, msg, colorama.Fore.RESET)
-        self.data_storage.add_message(msg, GREEN)
-        if self.settings.phase2[0]:
-            self.percent_load_on_adapter = 0
-            sleep(3)
-            start_index = len(self.data_storage.voltage) - 1
-
-            for reps in range(self.settings.phase2[1]):
-                self.progress += 3.75 / self.settings.phase2[1]
-                self.percent_load_on_adapter = 100
-                sleep(1)
-                while self.data_storage.load[start_index] == 0 and self.is_running:
-                    # Remove any preceding 0s in the results
-                    start_index += 1
-                while self.data_storage.load[start_index:].count(100) < 60 and self.is_running:
-                    # To make sure that each load level is exactly 6s
-                    sleep(.1)
-                self.progress += 8.125 / self.settings.phase2[1]
-                self.percent_load_on_adapter = 0
-                while self.data_storage.load[start_index:].count(0) <= 60 and self.is_running:
-                    # To make sure that each load level is exactly 6s
-                    sleep(.1)
-                self.progress += 8.125 / self.settings.phase2[1]
+        self.phase_message(2)
+        self.run_steps(2)
+        self.evaluate_phase(2)
 
-            self.test_values[1]["start_index"] = start_index
-            self.test_values[1]["stop_index"] = len(self.data_storage.voltage) - 1
+    def evaluate_phase(self, phase: int):
+        # The samples of phase 1 / 2 don't change after it ended, they're checked in the results worker while the next phase runs
+        if self.engine.token.cancelled:
+            return
+        if not self.sync_journal():
+            return
+        # stop() can end the journal meanwhile, the column views keep its mapping alive after that
+        with self._journal_lock:
+            if self.journal is None:
+                return
+            cols = self.journal.columns()
+        start = self.test_values[0]["stop_index"] if phase == 2 else 0
+        stop = self.test_values[phase - 1]["stop_index"]
+        self.phase_evals[phase] = self.results_worker.submit(self.eval_phase_job, self.results, phase, start, stop, cols,
+                                                             self.testable_adapters.selected_adapter)
 
-        if self.is_running:
-            self.phase3()
+    def eval_phase_job(self, results: EvaluateResults, phase: int, start: int, stop: int, cols: dict, adapter) -> PhaseResult:
+        # Results worker
+        res = results.eval_phase(phase, start, stop, cols["voltage"], cols["current"], cols["load"], cols["v_min"], cols["v_max"], adapter)
+        if res.passed:
+            msg = f"Phase {phase} passed"
+            print(colorama.Fore.GREEN, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, GREEN)
         else:
-            self.test_stopped()
+            msg = f"Phase {phase} failed, {len(res.OOB_results)} samples out of bounds"
+            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, RED)
+        return res
 
     def phase3(self):
-        msg = f"Phase 3:\n    - Testing OPP\n    - Testing loads over 100% \n    - Repeating test {self.settings.phase3[1]} times\n    - Looking for {self.settings.phase3[2]} OPP trips\n"
+        self.phase_message(3, f"Bisecting the OPP trip point down to {self.profile.opp['resolution']}%")
+        token = self.engine.token
+        for i in phase_rows(self.schedule, 3):
+            if token.cancelled:
+                return
+            self.schedule["start"][i] = self.data_storage.last_index() + 1
+            if self.schedule["kind"][i] == OPP_SEARCH:
+                self.test_values[2]["start_index"] = self.data_storage.last_index()
+                if not self.opp_search():
+                    return
+                self.check_opp()
+            else:
+                self.short_circuit_test()
+            self.schedule["stop"][i] = self.data_storage.last_index() + 1
+        self.percent_load_on_adapter = 0
+        self.test_values[2]["stop_index"] = self.data_storage.last_index()
+        token.sleep(1)
+
+    def opp_search(self) -> bool:
+        # Over-power search. Probes from the adapter's OPP_min up with a step that doubles until the adapter trips, then bisects between
+        # the highest load it held and the lowest one it tripped at down to the profile's resolution. If the first probe trips the rated
+        # load is probed before bisecting below it, an adapter that can't hold that has its trip point at 100%. After a trip the load
+        # goes to 0 and the next probe starts as soon as the voltage is back. False if the test got cancelled
+        token = self.engine.token
+        adapter = self.testable_adapters.selected_adapter
+        opp = self.profile.opp
+        safe_load = self.settings.max_current_shutdown / adapter.max_current * 100
+        search_start = self.clock.now_ns()
+        held, tripped, trip_index, step, overloads = None, None, None, opp["step_up"], 0
+        load = None
+        while tripped is None or held is None or tripped - held > opp["resolution"]:
+            if tripped is not None and held is None:
+                if tripped <= 100:
+                    break
+                load = 100
+            elif tripped is not None:
+                load = (held + tripped) / 2
+            elif load is None:
+                load = max(adapter.OPP_min, 100 + opp["resolution"])
+            else:
+                load = held + step
+                step *= 2
+            # Safety Shutdown
+            # Turn on If:
+            if load >= safe_load:
+                #   1. The current would exceed the max safe value
+                msg = f"Safety shutdown: Current would exceed max set safe value ({self.settings.max_current_shutdown}A)"
+            elif (self.clock.now_ns() - search_start) / 1e9 > opp["timeout"]:
+                #   2. The search has been on for longer than the profile allows, meaning its stuck
+                msg = "Safety shutdown: Test is stuck"
+            elif overloads >= opp["max_trips"]:
+                #   3. The adapter was overloaded as often as the profile allows
+                msg = f"Safety shutdown: Adapter tripped {overloads} times"
+            else:
+                msg = None
+            if msg:
+                if self.settings.exit_at_safety:
+                    msg += ", ending test, reducing load"
+                    print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+                    self.data_storage.add_message(msg, RED)
+                    self.percent_load_on_adapter = 0
+                    token.cancel("Safety shutdown")
+                    return False
+                msg += ", continuing test, reducing load"
+                print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+                self.data_storage.add_message(msg, RED)
+                break
+
+            start = self.data_storage.last_index() + 1
+            self.percent_load_on_adapter = load
+            dip = self.data_storage.wait_for_dip(adapter.min_voltage, start, self.samples_for(opp["probe"]), token)
+            self.progress += 2 / self.settings.phase3[1]
+            if dip is None:
+                return False
+            if dip < 0:
+                held = load
+                continue
+            overloads += 1
+            tripped, trip_index = load, dip
+            msg = f"OPP trip at {load:.1f}%"
+            print(colorama.Fore.YELLOW, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, ORANGE)
+            self.percent_load_on_adapter = 0
+            if not self.wait_for_recovery(dip + 1, opp["recovery"]):
+                return False
+
+        self.percent_load_on_adapter = 0
+        if tripped is not None:
+            if held is None:
+                msg = f"OPP trip at {tripped:.1f}% with no load held before it, {overloads} overload events"
+                held = float("nan")
+            else:
+                msg = f"OPP trip point between {held:.1f}% and {tripped:.1f}%, {overloads} overload events"
+            print(colorama.Fore.YELLOW, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, ORANGE)
+            self.test_values[2]["OPP_trip_index"].append(trip_index)
+            self.test_values[2]["OPP_trip_load"].append(round(tripped))
+            self.test_values[2]["OPP_brackets"].append([held, tripped, overloads])
+        return True
+
+    def wait_for_recovery(self, start: int, limit: float) -> bool:
+        # Waits until the voltage is back above the adapter's minimum after a trip, False if the test got cancelled
+        threshold = self.testable_adapters.selected_adapter.min_voltage
+        n = self.samples_for(self.profile.opp["recovery_hold"])
+        recovered = self.data_storage.wait_for_recovery(threshold, start, n, self.samples_for(limit), self.engine.token)
+        if recovered is None:
+            return False
+        if recovered < 0:
+            msg = f"Adapter didn't recover within {limit}s of the trip, continuing test"
+            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, RED)
+        return True
+
+    def short_circuit_test(self):
+        msg = "Testing Short Circuit"
         print(colorama.Fore.GREEN, msg, colorama.Fore.RESET)
         self.data_storage.add_message(msg, GREEN)
-        test_start_time = datetime.now()
-        if self.settings.phase3[0]:
-            for reps in range(self.settings.phase3[1]):
-                self.test_values[2]["start_index"] = len(self.data_storage.voltage) - 1
-                diff = 100
-                while self.is_running:
-                    # Safety Shutdown
-                    # Turn on If:
-                    if len(self.test_values[2]["OPP_trip_load"]) >= self.settings.phase3[2]:
-                        #   1. We hit the number of set repeats, break, continue normaly
-                        break
-
-                    elif (self.percent_load_on_adapter / 100) * self.testable_adapters.selected_adapter.max_current >= self.settings.max_current_shutdown:
-                        #   2. The current exceeds 3.2A
-                        if self.settings.exit_at_safety:
-                            msg = f"Safety shutdown: Current exceeded max set safe value ({self.settings.max_current_shutdown}A), ending test, reducing load"
-                            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
-                            self.data_storage.add_message(msg, RED)
-                            return
-
-                        elif not self.settings.exit_at_safety:
-                            msg = f"Safety shutdown: Current exceeded max set safe value ({self.settings.max_current_shutdown}A), continuing test, reducing load"
-                            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
-                            self.data_storage.add_message(msg, RED)
-                            break
-
-                    elif (datetime.now() - test_start_time).total_seconds() > 60:
-                        #   3. The test has been on for more than 60sec, meaning its stuck
-                        if self.settings.exit_at_safety:
-                            msg = "Safety shutdown: Test is stuck, ending test, reducing load"
-                            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
-                            self.data_storage.add_message(msg, RED)
-                            return
-
-                        elif not self.settings.exit_at_safety:
-                            msg = "Safety shutdown: Test is stuck, continuing test, reducing load"
-                            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
-                            self.data_storage.add_message(msg, RED)
-                            break
-                    if self.voltage < self.testable_adapters.selected_adapter.min_voltage:
-                        calcd_load = round((self.current / self.testable_adapters.selected_adapter.max_current) * 100)
-                        msg = f"OPP trip point :{calcd_load}%"
-                        print(colorama.Fore.YELLOW, msg, colorama.Fore.RESET)
-                        self.data_storage.add_message(msg, ORANGE)
-
-                        self.test_values[2]["OPP_trip_index"].append(len(self.data_storage.voltage) - 1)
-                        self.test_values[2]["OPP_trip_load"].append(calcd_load)
-                        diff -= 15
-                        self.percent_load_on_adapter = diff
-                        sleep(3)
-                    else:
-                        diff += 5
-
-                    sleep(.25)
-                    self.progress += 1.42587 / self.settings.phase3[1]
-                    self.percent_load_on_adapter = diff
-
-            msg = "Testing Short Circuit"
-            print(colorama.Fore.GREEN, msg, colorama.Fore.RESET)
-            self.data_storage.add_message(msg, GREEN)
+        token = self.engine.token
+        short_circuit = self.profile.short_circuit
 
-            # Short circuit protection
-            for x in range(self.settings.phase3[2]):
-                self.percent_load_on_adapter = 2111333
-                sleep(.5)
-                if self.voltage < 1.5 and self.current < .1:
-                    self.test_values[2]["short_circuit"] = True
-                    self.percent_load_on_adapter = 0
-                    sleep(3)
-                else:
-                    self.test_values[2]["short_circuit"] = False
+        # Short circuit protection
+        for x in range(self.settings.phase3[2]):
+            if token.cancelled:
+                break
+            start = self.data_storage.last_index() + 1
+            self.percent_load_on_adapter = SHORT_CIRCUIT_LOAD
+            token.sleep(short_circuit["hold"])
+            index, v, v_min, a = self.data_storage.latest()
+            if v < 1.5 and a < .1:
+                self.test_values[2]["short_circuit"] = True
+                self.percent_load_on_adapter = 0
+                if not self.wait_for_recovery(max(start, index + 1), short_circuit["recovery"]):
                     break
-        self.percent_load_on_adapter = 0
-        self.test_values[2]["stop_index"] = len(self.data_storage.voltage) - 1
-        sleep(1)
-        if self.is_running:
-            self.parse_results()
-        else:
-            self.test_stopped()
+            else:
+                self.test_values[2]["short_circuit"] = False
+                break
 
     def parse_results(self):
         self.progress = 70  # TODO daco musim spravit s tym progressom idk ci to chcem davat do gui
         msg = "Processing results, please wait ..."
         self.data_storage.add_message(msg, GREEN)
         print(colorama.Fore.GREEN, msg, colorama.Fore.RESET)
-        self.results.eval(self.data_storage.voltage, self.data_storage.current, self.data_storage.load,
-                          self.test_values, self.testable_adapters.selected_adapter)
-        self.results.write_data_into_file(self.testable_adapters.selected_adapter, self.settings)
+        # Evaluated straight from the journal mapping, the same samples a crash recovery would see.
+        # The journal now belongs to the file write, it's deleted once the file is on the card
+        if not self.sync_journal():
+            return
+        with self._journal_lock:
+            journal, self.journal = self.journal, None
+        cols = journal.columns()
+        rows = np.count_nonzero(self.schedule["phase"] == 3)
+        if self.engine.aborted:
+            self.end_early()
+        elif rows and "Phase3" in self.engine.state_times:
+            self.phase3_row_times[self.profile.name] = self.engine.state_times["Phase3"] / rows
+        steps = self.data_storage.load_steps(0, self.test_values[2]["stop_index"])
+        self.results.state_times = dict(self.engine.state_times)
+        self.results.profile, self.results.schedule, self.results.serial = self.profile.name, self.schedule, self.serial
+        # Phase 1 and 2 were evaluated while the test ran, only merged here
+        phase_results = {phase: future.result() for phase, future in self.phase_evals.items()}
+        self.results.eval(cols["voltage"], cols["current"], cols["load"], cols["timestamps"], cols["v_min"], cols["v_max"],
+                          self.test_values, self.testable_adapters.selected_adapter, steps, phase_results)
+        # The file and the graph are made in the background, the adapter can be swapped meanwhile
+        self.results_worker.submit(self.write_results, self.results, journal, self.testable_adapters.selected_adapter, copy.copy(self.settings))
         self.progress = 100
+
+    def write_results(self, results: EvaluateResults, journal: SampleJournal, adapter, settings: AppSettings):
+        # Results worker
+        try:
+            results.write_data_into_file(adapter, settings)
+        except Exception as e:
+            msg = f"Couldn't write the test file, run 'python journal.py recover' to write it from {journal.path}: {e}"
+            print(colorama.Fore.RED, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, RED)
+            journal.close()
+            return
+        journal.delete()
+        self.update_ptd = True  # The past tests list picks up the new file
+
+    def finish_test(self):
         self.stop(True)
         msg = "Test Finished"
         print(colorama.Fore.BLUE, msg, colorama.Fore.RESET)
         self.data_storage.add_message(msg, BLUE)
         self.data_storage.add_message(self.results.fin_message, "TEST RESULTS")
+        in_batch = self.batch is not None
+        if in_batch:
+            self.batch_unit_done(all(self.results.fin_message[:5]))
         del self.results
         self.results = EvaluateResults(self.data_storage)
-        sleep(2)
+        self.clock.sleep(2)
         self.progress = 0
         self.wait_to_stop = False
-        self.turn_off_LEDS()
-        self.update_ptd = True
+        if in_batch:
+            self.batch_next()
+        else:
+            self.turn_off_LEDS()
 
     def test_stopped(self):
         msg = "Test stopped successfully"
         self.data_storage.add_message(msg, BLUE)
         print(colorama.Fore.BLUE, msg, colorama.Fore.RESET)
-        sleep(.5)
+        self.clock.sleep(.5)
         self.wait_to_stop = False
         self.turn_off_LEDS()
+        if self.batch is not None and self.batch.current_start is not None:
+            self.batch.unit_aborted()
+            msg = f"Batch unit {self.batch.position + 1} wasn't finished, it stays next in the queue"
+            print(colorama.Fore.YELLOW, msg, colorama.Fore.RESET)
+            self.data_storage.add_message(msg, ORANGE)
+            self.batch_next()
         self.progress = 0
 
     def stop(self, ok_end):
         if self.is_running:
             self.is_running = False
+            if self.engine is not None:
+                self.engine.token.cancel()
             self.data_storage.testing = False
             self.wait_to_stop = True
+            self.end_journal()
             self.pwm.stop()
-            sleep(.1)
+            self.clock.sleep(.1)
             try:
                 self.pwm_thread.join()
             except (AttributeError, RuntimeError):
                 pass
+            # Converted for this adapter, the next one may have another max_current
+            self.setpoints = {}
             self.percent_load_on_adapter = 0
             if ok_end:
                 self.turn_on_green_LED()
@@ -582,12 +1017,17 @@ Vals:
     def shutdown(self):
         while self.stop(False) != "idle":
             continue
-        self.is_measuring = False
-        sleep(1)
+        self.sampler.stop()
+        self.temp_sampler.stop()
+        self.clock.sleep(1)
         try:
             self.v_a_thread.join()
             self.v_a_thread = None
-        except ValueError:
+        except (AttributeError, ValueError):
             pass
-        GPIO.cleanup()
+        # Test files still being written are finished first
+        self.results_worker.shutdown(wait=True)
+        if isinstance(self.sampler, SamplerProcess):
+            self.sampler.close()
+        self.backend.cleanup()
 